@@ -0,0 +1,339 @@
+"""KFC星期四插件离线基准测试
+
+不需要AstrBot、LLM和QQ账号：用假的provider、会话管理器和aiocqhttp客户端构造插件，
+对10/100/1000个群各广播一个时间点，统计整个时间点耗时、单群耗时p50/p99、LLM调用次数、
+发送字节数，以及用虚拟时钟模拟运行时每个模拟日的调度器唤醒次数。
+
+用法:
+    python benchmark.py
+    python benchmark.py --groups 10 100 1000 --llm-latency 0.5 --llm-failure-rate 0.1
+    python benchmark.py --set per_group_variation=true --set context_mode='"last_k"'
+"""
+import argparse
+import asyncio
+import datetime
+import importlib.util
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def install_astrbot_stubs():
+    """在sys.modules中放入最小的astrbot桩模块，只提供插件导入和运行需要的名字"""
+    def module(name, **attrs):
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        sys.modules[name] = mod
+        return mod
+
+    class PermissionType:
+        ADMIN = "admin"
+        MEMBER = "member"
+
+    class PlatformAdapterType:
+        AIOCQHTTP = "aiocqhttp"
+
+    def passthrough(*args, **kwargs):
+        return lambda func: func
+
+    class Star:
+        def __init__(self, context):
+            self.context = context
+
+    class Plain:
+        def __init__(self, text):
+            self.text = text
+
+        def toDict(self):
+            return {"type": "text", "data": {"text": self.text}}
+
+    class Image:
+        def __init__(self, file):
+            self.file = file
+
+        @classmethod
+        def fromFileSystem(cls, path):
+            return cls(f"file:///{path}")
+
+        @classmethod
+        def fromBase64(cls, data):
+            return cls(f"base64://{data}")
+
+        def toDict(self):
+            return {"type": "image", "data": {"file": self.file}}
+
+    filter_module = module(
+        "astrbot.api.event.filter",
+        PermissionType=PermissionType,
+        PlatformAdapterType=PlatformAdapterType,
+        command=passthrough,
+        permission_type=passthrough,
+    )
+    module("astrbot")
+    module("astrbot.api", logger=logging.getLogger("astrbot"))
+    module("astrbot.api.event", filter=filter_module, AstrMessageEvent=type("AstrMessageEvent", (), {}))
+    module("astrbot.api.star", Context=type("Context", (), {}), Star=Star, register=passthrough)
+    module("astrbot.api.message_components", Plain=Plain, Image=Image)
+    module("astrbot.core")
+    module("astrbot.core.config")
+    module("astrbot.core.config.astrbot_config", AstrBotConfig=dict)
+
+
+def load_plugin_module(workdir: str):
+    """把插件复制到临时目录再导入，账本和预生成文件都写在临时目录，不影响插件自身的数据"""
+    for name in ("main.py", "收款码.jpg"):
+        source = os.path.join(PLUGIN_DIR, name)
+        if os.path.exists(source):
+            shutil.copy(source, workdir)
+    spec = importlib.util.spec_from_file_location("kfc_benchmark_plugin", os.path.join(workdir, "main.py"))
+    plugin_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin_module)
+    return plugin_module
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.completion_text = text
+
+
+class FakeProvider:
+    """可配置延迟和失败率的LLM"""
+
+    curr_personality = None
+
+    def __init__(self, latency: float, failure_rate: float, rng: random.Random):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = rng
+        self.calls = 0
+
+    async def text_chat(self, prompt, session_id=None, contexts=None, system_prompt="", **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if self.rng.random() < self.failure_rate:
+            raise RuntimeError("模拟LLM调用失败")
+        return FakeResponse(f"疯狂星期四到了！{prompt[:20]}…V我50🍗")
+
+
+class FakeConversation:
+    def __init__(self, history: str):
+        self.history = history
+        self.persona_id = None
+
+
+class FakeConversationManager:
+    def __init__(self, history_messages: int):
+        history = [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": f"第{i}条历史消息"}
+            for i in range(history_messages)
+        ]
+        self.history = json.dumps(history, ensure_ascii=False)
+
+    async def get_curr_conversation_id(self, unified_msg_origin):
+        return f"cid-{unified_msg_origin}"
+
+    async def new_conversation(self, unified_msg_origin):
+        return f"cid-{unified_msg_origin}"
+
+    async def get_conversation(self, unified_msg_origin, conversation_id):
+        return FakeConversation(self.history)
+
+
+class FakeProviderManager:
+    personas = [{"name": "default", "prompt": "你是一个热爱KFC的群友"}]
+    selected_default_persona = {"name": "default"}
+
+
+class FakeClient:
+    """记录send_group_msg调用的aiocqhttp客户端"""
+
+    def __init__(self, latency: float, failure_rate: float, rng: random.Random):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = rng
+        self.calls = 0
+        self.bytes_sent = 0
+        self._messages = {}
+
+    async def send_group_msg(self, group_id, message):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if self.rng.random() < self.failure_rate:
+            raise RuntimeError("模拟发送失败")
+        self.bytes_sent += len(json.dumps(message, ensure_ascii=False).encode("utf-8"))
+        message_id = len(self._messages) + 1
+        self._messages[message_id] = message
+        return {"message_id": message_id}
+
+    async def get_msg(self, message_id):
+        # 和go-cqhttp一样，已发送图片的file字段返回平台侧的文件ID
+        segments = []
+        for segment in self._messages.get(message_id) or []:
+            if isinstance(segment, dict) and segment.get("type") == "image":
+                segment = {"type": "image", "data": {"file": f"fake-file-id-{message_id}.image"}}
+            segments.append(segment)
+        return {"message": segments}
+
+
+class FakeMeta:
+    def __init__(self, platform_id: str):
+        self.name = "aiocqhttp"
+        self.id = platform_id
+
+
+class FakePlatform:
+    def __init__(self, platform_id: str, client: FakeClient):
+        self._meta = FakeMeta(platform_id)
+        self._client = client
+
+    def meta(self):
+        return self._meta
+
+    def get_client(self):
+        return self._client
+
+
+class FakePlatformManager:
+    def __init__(self, platforms: list):
+        self.platforms = platforms
+
+    def get_insts(self):
+        return self.platforms
+
+
+class FakeContext:
+    def __init__(self, args, rng: random.Random):
+        self.provider = FakeProvider(args.llm_latency, args.llm_failure_rate, rng)
+        self.conversation_manager = FakeConversationManager(args.history_messages)
+        self.provider_manager = FakeProviderManager()
+        self.clients = [FakeClient(args.send_latency, args.send_failure_rate, rng) for _ in range(args.instances)]
+        self.platform_manager = FakePlatformManager(
+            [FakePlatform(f"qq{i}", client) for i, client in enumerate(self.clients)]
+        )
+
+    def get_using_provider(self):
+        return self.provider
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def run_scenario(plugin_module, group_count: int, args) -> dict:
+    rng = random.Random(args.seed)
+    context = FakeContext(args, rng)
+    groups = [str(100000 + i) for i in range(group_count)]
+    config = {
+        "enabled_groups": groups,
+        "send_concurrency": args.concurrency,
+        "send_rate_per_second": args.rate,
+        "send_rate_burst": args.burst,
+        # 每个群会记录多个阶段的事件，缓冲区要装得下整个时间点
+        "metrics_buffer_size": group_count * 8 + 64,
+    }
+    config.update(args.overrides)
+
+    plugin = plugin_module.KFCThursdayPlugin(context, config)
+    try:
+        slot_key = f"benchmark-{group_count}-{time.time_ns()}"
+        prompt = "今天是疯狂星期四，写一段让群友V你50的文案"
+        plugin._ledger.begin_slot(slot_key, prompt, time.time(), groups)
+
+        started = time.monotonic()
+        await plugin._broadcast_slot(slot_key, prompt, groups)
+        slot_seconds = time.monotonic() - started
+
+        latencies = [
+            event[5] for event in plugin._metrics.events
+            if event[1] == "group_total" and event[2] == slot_key
+        ]
+        # 用虚拟时钟空跑调度循环，统计每个模拟日的唤醒次数
+        simulation = await plugin.simulate(args.days, datetime.datetime(2024, 1, 1))
+
+        failed = sum(1 for event in plugin._metrics.events if event[1] == "group_total" and event[2] == slot_key and not event[6])
+        return {
+            "groups": group_count,
+            "slot_seconds": slot_seconds,
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "failed": failed,
+            "llm_calls": context.provider.calls,
+            "send_calls": sum(client.calls for client in context.clients),
+            "bytes_sent": sum(client.bytes_sent for client in context.clients),
+            "wakeups_per_day": simulation["wakeups"] / args.days,
+            "simulation_seconds": simulation["elapsed"],
+        }
+    finally:
+        await plugin.terminate()
+
+
+def parse_override(text: str) -> tuple:
+    key, _, value = text.partition("=")
+    try:
+        return key, json.loads(value)
+    except json.JSONDecodeError:
+        return key, value
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="KFC星期四插件离线基准测试")
+    parser.add_argument("--groups", type=int, nargs="+", default=[10, 100, 1000], help="每轮的群数量")
+    parser.add_argument("--instances", type=int, default=1, help="aiocqhttp实例数量")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="每次LLM调用的秒数")
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0, help="LLM调用失败的概率")
+    parser.add_argument("--send-latency", type=float, default=0.01, help="每次send_group_msg的秒数")
+    parser.add_argument("--send-failure-rate", type=float, default=0.0, help="send_group_msg失败的概率")
+    parser.add_argument("--history-messages", type=int, default=20, help="每个群会话历史的消息条数")
+    parser.add_argument("--concurrency", type=int, default=5, help="send_concurrency配置")
+    parser.add_argument("--rate", type=float, default=1000.0, help="send_rate_per_second配置（默认不限速）")
+    parser.add_argument("--burst", type=int, default=100, help="send_rate_burst配置")
+    parser.add_argument("--days", type=int, default=28, help="用虚拟时钟模拟运行的天数，用于统计调度器唤醒次数")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="KEY=JSON",
+                        help="覆盖插件配置项，值按JSON解析，例如 --set per_group_variation=true")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    parser.add_argument("--verbose", action="store_true", help="输出插件日志")
+    args = parser.parse_args(argv)
+    args.overrides = dict(parse_override(item) for item in args.overrides)
+    return args
+
+
+async def run(args) -> list:
+    workdir = tempfile.mkdtemp(prefix="kfc_benchmark_")
+    try:
+        plugin_module = load_plugin_module(workdir)
+        return [await run_scenario(plugin_module, group_count, args) for group_count in args.groups]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR, format="%(levelname)s %(message)s")
+    install_astrbot_stubs()
+    results = asyncio.run(run(args))
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    header = f"{'群数':>6} {'时间点耗时':>10} {'单群p50':>9} {'单群p99':>9} {'失败':>5} {'LLM调用':>8} {'发送调用':>8} {'发送字节':>10} {'日唤醒':>7} {'模拟耗时':>8}"
+    print(header)
+    for result in results:
+        print(
+            f"{result['groups']:>6} {result['slot_seconds']:>9.3f}s {result['p50']:>8.3f}s {result['p99']:>8.3f}s "
+            f"{result['failed']:>5} {result['llm_calls']:>8} {result['send_calls']:>8} {result['bytes_sent']:>10} "
+            f"{result['wakeups_per_day']:>7.2f} {result['simulation_seconds']:>7.3f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,1446 @@ from astrbot.api.star import Context, Star, register
 from astrbot.api import logger
 from astrbot.core.config.astrbot_config import AstrBotConfig
 from astrbot.api.event.filter import PlatformAdapterType
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass
 import datetime
 import asyncio
+import heapq
+import base64
+import bisect
+import hashlib
 import json
 import random
 import os
+import socket
+import sqlite3
 import time
+import uuid
+
+# 星期四预设时间点: (标识, 时间, 启用开关配置项)
+PRESET_SLOTS = (
+    ("morning", "10:00", "morning_enabled"),
+    ("noon", "12:00", "noon_enabled"),
+    ("evening", "18:00", "evening_enabled"),
+    ("night", "20:00", "night_enabled"),
+)
+
+# 预设时间点的默认提示词
+PRESET_PROMPTS = {
+    "morning": "请你以撒娇的语气，写一段请求对方转账50元的消息。你非常想吃KFC，而今天是疯狂星期四，特地想用可爱的方式让对方给你转账。。",
+    "noon": "请你以可怜的语气，写一段请求对方转账50元的消息。你特别想吃KFC，但钱包空空，今天又是疯狂星期四，希望通过可怜的方式让对方转账。",
+    "evening": "你以搞笑的语气，写一段请求对方转账50元的消息。你特别想吃KFC，而今天是疯狂星期四，用幽默风趣的方式让对方给你转账。",
+    "night": "请你以卖萌的语气，写一段请求对方转账50元的消息。你超级想吃KFC，今天是疯狂星期四，用萌萌的语气请求对方转账。",
+}
+
+# 触发时间已过去超过该秒数（例如系统休眠）则放弃本次发送
+MAX_FIRE_LAG = 600
+
+# 启动时补发该秒数内未发送完成的时间点
+RESUME_WINDOW = 3600
+
+
+class SystemClock:
+    """系统时钟，定时任务、账本和限流器都通过时钟获取时间和休眠"""
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now()
+
+    def time(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+    async def wait(self, event: asyncio.Event, timeout: float = None) -> bool:
+        """等待事件，返回事件是否在超时前被设置"""
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class SimulatedClock(SystemClock):
+    """虚拟时钟：休眠只登记唤醒时间，由run_until在所有任务都空闲后直接跳到最早的唤醒时间"""
+
+    # 每次推进时间前最多让出事件循环的次数
+    SETTLE_ROUNDS = 10000
+
+    def __init__(self, start: datetime.datetime = None):
+        self._now = (start or datetime.datetime.now()).timestamp()
+        self._sleepers = []
+        self._sequence = 0
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self._now)
+
+    def time(self) -> float:
+        return self._now
+
+    def monotonic(self) -> float:
+        return self._now
+
+    async def sleep(self, seconds: float):
+        if seconds <= 0:
+            await asyncio.sleep(0)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._sequence += 1
+        heapq.heappush(self._sleepers, (self._now + seconds, self._sequence, future))
+        await future
+
+    async def wait(self, event: asyncio.Event, timeout: float = None) -> bool:
+        if event.is_set():
+            return True
+        if timeout is None:
+            await event.wait()
+            return True
+        waiter = asyncio.ensure_future(event.wait())
+        sleeper = asyncio.ensure_future(self.sleep(timeout))
+        try:
+            await asyncio.wait((waiter, sleeper), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+            sleeper.cancel()
+        return event.is_set()
+
+    # 没有就绪队列可查时，连续这么多轮没有新的休眠登记即视为所有任务都在等待
+    QUIET_ROUNDS = 100
+
+    @staticmethod
+    def _ready_queue():
+        """CPython事件循环的就绪队列，其他事件循环返回None"""
+        return getattr(asyncio.get_running_loop(), "_ready", None)
+
+    async def _settle(self):
+        """让出事件循环，直到其他任务都在等待
+
+        CPython的事件循环可直接判断就绪队列是否为空；其他事件循环没有该属性，
+        改为连续QUIET_ROUNDS轮没有任务登记新的休眠时视为空闲
+        """
+        ready = self._ready_queue()
+        last_sequence, quiet = self._sequence, 0
+        for _ in range(self.SETTLE_ROUNDS):
+            await asyncio.sleep(0)
+            if ready is not None:
+                if not ready:
+                    return
+                continue
+            if self._sequence != last_sequence:
+                last_sequence, quiet = self._sequence, 0
+            else:
+                quiet += 1
+                if quiet >= self.QUIET_ROUNDS:
+                    return
+
+    async def run_until(self, end: datetime.datetime):
+        """推进虚拟时间到end，依次唤醒到期的休眠"""
+        end_ts = end.timestamp()
+        while True:
+            await self._settle()
+            while self._sleepers and self._sleepers[0][2].done():
+                heapq.heappop(self._sleepers)
+            if not self._sleepers or self._sleepers[0][0] > end_ts:
+                break
+            wake_at, _, future = heapq.heappop(self._sleepers)
+            self._now = max(self._now, wake_at)
+            future.set_result(None)
+        self._now = max(self._now, end_ts)
+        await self._settle()
+
+
+class KFCMetrics:
+    """发送链路的内存指标：各阶段耗时直方图、按群/平台的成功失败计数，以及固定大小的最近事件环形缓冲"""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, buffer_size: int = 2048):
+        self.events = deque(maxlen=max(1, buffer_size))
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, stage: str, seconds: float, ok: bool = True, group_id=None, platform: str = None, slot: str = None):
+        """记录一次阶段耗时"""
+        self.events.append((time.time(), stage, slot, group_id, platform, seconds, ok))
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+        if not ok:
+            self.incr(f"{stage}_failed")
+
+    @contextmanager
+    def measure(self, stage: str, **labels):
+        """统计代码块耗时，抛出异常时记为失败"""
+        started = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.observe(stage, time.monotonic() - started, ok=False, **labels)
+            raise
+        self.observe(stage, time.monotonic() - started, **labels)
+
+    def incr(self, name: str, *labels, amount: int = 1):
+        key = (name,) + tuple(str(label) for label in labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def record_result(self, group_id, platform: str, ok: bool):
+        """记录单个群的最终发送结果"""
+        status = "sent" if ok else "failed"
+        self.incr("group", group_id, status)
+        self.incr("platform", platform, status)
+
+    def _recent(self, stage: str) -> list:
+        return sorted(event[5] for event in self.events if event[1] == stage)
+
+    @staticmethod
+    def _percentile(values: list, q: float) -> float:
+        return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+    def summary(self, top: int = 5) -> str:
+        """生成适合在聊天中展示的指标摘要"""
+        lines = ["KFC发送指标（最近事件）:"]
+        for stage in sorted(self.histograms):
+            values = self._recent(stage)
+            if not values:
+                continue
+            lines.append(
+                f"- {stage}: {len(values)}次 p50={self._percentile(values, 0.5):.3f}s "
+                f"p99={self._percentile(values, 0.99):.3f}s max={values[-1]:.3f}s"
+            )
+
+        platform_lines = [
+            f"- {key[1]}: {key[2]} {value}"
+            for key, value in sorted(self.counters.items()) if key[0] == "platform"
+        ]
+        if platform_lines:
+            lines.append("平台发送结果:")
+            lines.extend(platform_lines)
+
+        slow = {}
+        for _, stage, _, group_id, _, seconds, _ in self.events:
+            if stage == "group_total" and group_id is not None:
+                slow[group_id] = max(slow.get(group_id, 0), seconds)
+        if slow:
+            lines.append("最慢的群:")
+            for group_id, seconds in sorted(slow.items(), key=lambda item: -item[1])[:top]:
+                lines.append(f"- {group_id}: {seconds:.3f}s")
+
+        failing = sorted(
+            ((key[1], value) for key, value in self.counters.items() if key[0] == "group" and key[2] == "failed"),
+            key=lambda item: -item[1],
+        )
+        if failing:
+            lines.append("失败最多的群:")
+            lines.extend(f"- {group_id}: {count}次" for group_id, count in failing[:top])
+
+        other = [f"- {key[0]}: {value}" for key, value in sorted(self.counters.items()) if len(key) == 1]
+        if other:
+            lines.append("其他计数:")
+            lines.extend(other)
+        return "\n".join(lines)
+
+    def prometheus_text(self) -> str:
+        """导出Prometheus文本格式"""
+        lines = ["# TYPE kfc_stage_seconds histogram"]
+        for stage, histogram in sorted(self.histograms.items()):
+            for bound, count in zip(self.BUCKETS, histogram["buckets"]):
+                lines.append(f'kfc_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'kfc_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'kfc_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]:.6f}')
+            lines.append(f'kfc_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+
+        lines.append("# TYPE kfc_events_total counter")
+        for key, value in sorted(self.counters.items()):
+            if key[0] == "group":
+                labels = f'kind="group",group="{key[1]}",status="{key[2]}"'
+            elif key[0] == "platform":
+                labels = f'kind="platform",platform="{key[1]}",status="{key[2]}"'
+            else:
+                labels = f'kind="{key[0]}"'
+            lines.append(f"kfc_events_total{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str):
+        """把Prometheus文本写入文件，供node_exporter等采集"""
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"写入指标文件失败: {e}")
+
+
+class TokenBucket:
+    """令牌桶限流器，按固定速率补充令牌，允许一定的突发"""
+
+    def __init__(self, rate: float, capacity: int, clock: SystemClock = None):
+        self.rate = max(rate, 0.001)
+        self.capacity = max(capacity, 1)
+        self.clock = clock or SystemClock()
+        self.tokens = float(self.capacity)
+        self.updated = self.clock.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """取出一个令牌，令牌不足时等待补充"""
+        async with self._lock:
+            while True:
+                now = self.clock.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await self.clock.sleep((1 - self.tokens) / self.rate)
+
+    def available(self) -> bool:
+        """是否有可用的令牌，不会取出令牌"""
+        now = self.clock.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens >= 1
+
+    def try_acquire(self) -> bool:
+        """不等待地取出一个令牌，令牌不足时返回False"""
+        if self.available():
+            self.tokens -= 1
+            return True
+        return False
+
+
+class KeyedRateLimiter:
+    """按键（群、用户）区分的非阻塞限流器，只保留最近使用的max_keys个令牌桶"""
+
+    def __init__(self, per_minute: float, clock: SystemClock = None, max_keys: int = 4096):
+        self.per_minute = per_minute
+        self.clock = clock or SystemClock()
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def _bucket(self, key) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.per_minute / 60, max(1, int(self.per_minute)), self.clock)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def check(self, key) -> bool:
+        """是否允许本次请求，不消耗令牌；per_minute不大于0时不限流"""
+        return self.per_minute <= 0 or self._bucket(key).available()
+
+    def allow(self, key) -> bool:
+        """允许时消耗一个令牌；per_minute不大于0时不限流"""
+        return self.per_minute <= 0 or self._bucket(key).try_acquire()
+
+
+class GenerationCache:
+    """文案生成缓存，相同键的并发请求只触发一次生成"""
+
+    def __init__(self, max_entries: int = 256, clock: SystemClock = None):
+        self.max_entries = max_entries
+        self.clock = clock or SystemClock()
+        self._entries = OrderedDict()
+
+    async def get_or_create(self, key, factory, timeout: float = None):
+        """获取缓存结果，不存在时调用factory生成；生成失败不会被缓存
+
+        timeout从生成任务开始时计时，超时抛出asyncio.TimeoutError；已生成完的结果总是直接返回
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda finished: self._discard_failed(key, finished))
+            entry = self._entries[key] = (task, self.clock.monotonic())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        task, started = entry
+        if timeout is None or task.done():
+            return await asyncio.shield(task)
+        # 共享的生成任务被shield保护，超时只影响当前等待方，其他等待方仍可使用它的结果
+        remaining = started + timeout - self.clock.monotonic()
+        return await asyncio.wait_for(asyncio.shield(task), timeout=max(0.0, remaining))
+
+    def _discard_failed(self, key, task):
+        # 等待方都已超时离开时也要取走异常，避免事件循环报告未处理的异常
+        if (task.cancelled() or task.exception() is not None) and self._entries.get(key, (None,))[0] is task:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+
+def shingle_hashes(text: str, size: int = 3) -> frozenset:
+    """文本的字符shingle哈希集合，忽略空白、标点和表情，用于判断两段文案是否近似重复"""
+    normalized = "".join(ch for ch in text.lower() if ch.isalnum())
+    if len(normalized) <= size:
+        return frozenset({hash(normalized)})
+    return frozenset(hash(normalized[i:i + size]) for i in range(len(normalized) - size + 1))
+
+
+def jaccard(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class CopyPool:
+    """按人格区分的预生成文案池
+
+    /kfc 直接从池中取文案；入池前与池中文案及最近发出的文案比较shingle相似度，过滤近似重复的文案
+    """
+
+    def __init__(self, similarity: float = 0.6, history_size: int = 32):
+        self.similarity = similarity
+        self._pools = {}
+        self._served = {}
+        self.history_size = history_size
+
+    def size(self, key) -> int:
+        return len(self._pools.get(key, ()))
+
+    def is_duplicate(self, key, shingles: frozenset) -> bool:
+        recent = [entry[1] for entry in self._pools.get(key, ())] + list(self._served.get(key, ()))
+        return any(jaccard(shingles, other) >= self.similarity for other in recent)
+
+    def add(self, key, text: str) -> bool:
+        """文案入池，与已有文案近似重复时丢弃并返回False"""
+        shingles = shingle_hashes(text)
+        if self.is_duplicate(key, shingles):
+            return False
+        self._pools.setdefault(key, deque()).append((text, shingles))
+        return True
+
+    def take(self, key):
+        """取出一条文案并记入最近发出的历史，池为空时返回None"""
+        pool = self._pools.get(key)
+        if not pool:
+            return None
+        text, shingles = pool.popleft()
+        self._served.setdefault(key, deque(maxlen=self.history_size)).append(shingles)
+        return text
+
+    def mark_served(self, key, text: str):
+        """把不经过文案池直接发出的文案记入最近发出的历史"""
+        self._served.setdefault(key, deque(maxlen=self.history_size)).append(shingle_hashes(text))
+
+    def clear(self):
+        self._pools.clear()
+        self._served.clear()
+
+
+class PregeneratedStore:
+    """预生成文案的磁盘队列，插件重启后仍可使用已生成的文案
+
+    写入只更新内存，由调用方在一批文案生成完后调用flush()一次性写盘；path为None时只保存在内存中
+    """
+
+    def __init__(self, path: str = None, ttl_seconds: int = 86400):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}
+        self._dirty = False
+        self._load()
+
+    @staticmethod
+    def _hash_key(key) -> str:
+        return hashlib.sha1(json.dumps(key, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except Exception as e:
+            logger.warning(f"读取预生成文案失败: {e}")
+            return
+        now = time.time()
+        self._entries = {k: v for k, v in entries.items() if now - v.get("created", 0) < self.ttl_seconds}
+
+    def flush(self):
+        """有未写盘的变化时写入文件"""
+        if not self._dirty or self.path is None:
+            return
+        self._dirty = False
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning(f"保存预生成文案失败: {e}")
+
+    def get(self, key):
+        entry = self._entries.get(self._hash_key(key))
+        return entry["text"] if entry else None
+
+    def put(self, key, slot_key: str, text: str):
+        self._entries[self._hash_key(key)] = {"slot": slot_key, "text": text, "created": time.time()}
+        self._dirty = True
+
+    def discard_slot(self, slot_key: str):
+        """时间点发送完成后清理它的预生成文案并写盘"""
+        remaining = {k: v for k, v in self._entries.items() if v.get("slot") != slot_key}
+        if len(remaining) != len(self._entries):
+            self._entries = remaining
+            self._dirty = True
+        self.flush()
+
+
+class DeadLetterStore:
+    """重试后仍发送失败的群，保存在磁盘上供管理员重放；path为None时只保存在内存中"""
+
+    def __init__(self, path: str = None, max_entries: int = 1000):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = []
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except Exception as e:
+                logger.warning(f"读取死信列表失败: {e}")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _save(self):
+        if self.path is None:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning(f"保存死信列表失败: {e}")
+
+    def add(self, slot_key: str, group_id, prompt: str, platform_key: str, attempts: int):
+        self._entries.append({
+            "slot": slot_key,
+            "group_id": str(group_id),
+            "prompt": prompt,
+            "platform": platform_key,
+            "attempts": attempts,
+            "failed_at": time.time(),
+        })
+        # 超出上限时丢弃最早的记录
+        del self._entries[:-self.max_entries]
+        self._save()
+
+    def entries(self) -> list:
+        return list(self._entries)
+
+    def peek(self, limit: int = None) -> list:
+        """最早的limit条记录（默认全部），不会从列表中移除"""
+        count = len(self._entries) if limit is None else max(0, limit)
+        return self._entries[:count]
+
+    def remove(self, entries: list):
+        """移除已重放成功或已交给重试任务的记录"""
+        removed = {id(entry) for entry in entries}
+        remaining = [entry for entry in self._entries if id(entry) not in removed]
+        if len(remaining) != len(self._entries):
+            self._entries = remaining
+            self._save()
+
+
+class QRCodeAsset:
+    """收款码图片资源：内容只在文件变化时重新读取编码，并记住各平台可用的发送方式"""
+
+    TRANSPORTS = ("file", "base64")
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        self.base64 = None
+        self._mtime = None
+        self._preferred = {}
+        self._file_ids = {}
+        self._probed = set()
+
+    @property
+    def exists(self) -> bool:
+        return self.base64 is not None
+
+    def refresh(self) -> bool:
+        """检查文件修改时间，变化时重新加载，返回图片是否可用"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            if self._mtime != -1:
+                logger.warning(f"收款码图片不存在: {self.path}")
+            self._reset(None)
+            self._mtime = -1
+            return False
+
+        if mtime != self._mtime:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            self._reset(base64.b64encode(data).decode())
+            self._mtime = mtime
+            logger.info(f"已加载收款码图片: {self.path}（{len(data)} 字节）")
+        return True
+
+    def _reset(self, encoded):
+        self.base64 = encoded
+        self._file_ids.clear()
+        self._probed.clear()
+
+    def sources(self, platform_key: str) -> list:
+        """按优先级返回该平台可尝试的图片来源: [(发送方式, file参数)]"""
+        sources = []
+        if platform_key in self._file_ids:
+            sources.append(("file_id", self._file_ids[platform_key]))
+        preferred = self._preferred.get(platform_key)
+        for transport in sorted(self.TRANSPORTS, key=lambda t: t != preferred):
+            if transport == "file":
+                sources.append((transport, f"file:///{self.path}"))
+            else:
+                sources.append((transport, f"base64://{self.base64}"))
+        return sources
+
+    def mark_succeeded(self, platform_key: str, transport: str) -> bool:
+        """记录发送成功的方式，返回是否需要查询平台返回的文件ID"""
+        if transport == "file_id":
+            return False
+        self._preferred[platform_key] = transport
+        if platform_key in self._probed:
+            return False
+        self._probed.add(platform_key)
+        return True
+
+    def mark_failed(self, platform_key: str, transport: str):
+        if transport == "file_id":
+            self._file_ids.pop(platform_key, None)
+        elif self._preferred.get(platform_key) == transport:
+            del self._preferred[platform_key]
+
+    def remember_file_id(self, platform_key: str, file_id: str):
+        self._file_ids[platform_key] = file_id
+
+
+class SendLedger:
+    """发送记录账本（SQLite WAL），按(时间点, 群)记录发送状态
+
+    每个群发送前通过一条UPDATE原子认领，多个实例共享同一个数据库文件时也不会重复发送
+    """
+
+    def __init__(self, path: str, claim_ttl: int = 300, clock: SystemClock = None):
+        self.path = path
+        self.claim_ttl = claim_ttl
+        self.clock = clock or SystemClock()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS slots (
+                slot TEXT PRIMARY KEY,
+                prompt TEXT NOT NULL,
+                fire_at REAL NOT NULL,
+                status TEXT NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS sends (
+                slot TEXT NOT NULL,
+                group_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                owner TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (slot, group_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_slots_status ON slots (status, fire_at);
+            CREATE INDEX IF NOT EXISTS idx_sends_updated ON sends (updated);
+        """)
+
+    def begin_slot(self, slot: str, prompt: str, fire_at: float, groups: list):
+        """登记时间点及其所有目标群，已登记的不会被覆盖"""
+        now = self.clock.time()
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute(
+                "INSERT OR IGNORE INTO slots (slot, prompt, fire_at, status, updated) VALUES (?, ?, ?, 'running', ?)",
+                (slot, prompt, fire_at, now),
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO sends (slot, group_id, status, updated) VALUES (?, ?, 'pending', ?)",
+                [(slot, str(group_id), now) for group_id in groups],
+            )
+
+    def claim(self, slot: str, group_id) -> bool:
+        """原子认领一个群的发送权，待发送或认领已过期的群才能被认领"""
+        now = self.clock.time()
+        cursor = self._conn.execute(
+            "UPDATE sends SET status = 'claimed', owner = ?, updated = ? "
+            "WHERE slot = ? AND group_id = ? AND (status = 'pending' OR (status = 'claimed' AND updated < ?))",
+            (self.owner, now, slot, str(group_id), now - self.claim_ttl),
+        )
+        return cursor.rowcount == 1
+
+    def mark(self, slot: str, group_id, status: str):
+        """记录群的发送结果（sent / failed）"""
+        self._conn.execute(
+            "UPDATE sends SET status = ?, updated = ? WHERE slot = ? AND group_id = ? AND owner = ?",
+            (status, self.clock.time(), slot, str(group_id), self.owner),
+        )
+
+    def renew(self, slot: str, group_id):
+        """刷新本实例对群的认领时间，长时间重试时避免认领过期"""
+        self._conn.execute(
+            "UPDATE sends SET updated = ? WHERE slot = ? AND group_id = ? AND owner = ? AND status = 'claimed'",
+            (self.clock.time(), slot, str(group_id), self.owner),
+        )
+
+    def reopen(self, slot: str, group_id):
+        """把发送失败的群重新置为待发送"""
+        now = self.clock.time()
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute(
+                "UPDATE sends SET status = 'pending', updated = ? WHERE slot = ? AND group_id = ? AND status = 'failed'",
+                (now, slot, str(group_id)),
+            )
+            self._conn.execute("UPDATE slots SET status = 'running', updated = ? WHERE slot = ?", (now, slot))
+
+    def statuses(self, slot: str, groups: list) -> dict:
+        """群的当前发送状态: 群号 -> 状态"""
+        placeholders = ",".join("?" * len(groups))
+        return dict(self._conn.execute(
+            f"SELECT group_id, status FROM sends WHERE slot = ? AND group_id IN ({placeholders})",
+            [slot] + [str(group_id) for group_id in groups],
+        ).fetchall())
+
+    def restore_failed(self, slot: str, groups: list):
+        """重放没有发出去的群恢复为发送失败"""
+        self._conn.executemany(
+            "UPDATE sends SET status = 'failed', updated = ? WHERE slot = ? AND group_id = ? AND status = 'pending'",
+            [(self.clock.time(), slot, str(group_id)) for group_id in groups],
+        )
+
+    def release_claims(self, slot: str, live_owners) -> int:
+        """把已失联的工作进程认领的群重新置为待发送，返回释放的群数"""
+        live_owners = list(live_owners)
+        placeholders = ",".join("?" * len(live_owners))
+        cursor = self._conn.execute(
+            f"UPDATE sends SET status = 'pending', owner = NULL, updated = ? "
+            f"WHERE slot = ? AND status = 'claimed' AND owner NOT IN ({placeholders})",
+            [self.clock.time(), slot] + live_owners,
+        )
+        return cursor.rowcount
+
+    def finish_slot(self, slot: str):
+        """所有群都已有发送结果时，把时间点标记为完成"""
+        self._conn.execute(
+            "UPDATE slots SET status = 'done', updated = ? WHERE slot = ? AND NOT EXISTS "
+            "(SELECT 1 FROM sends WHERE slot = ? AND status IN ('pending', 'claimed'))",
+            (self.clock.time(), slot, slot),
+        )
+
+    def is_slot_done(self, slot: str) -> bool:
+        row = self._conn.execute("SELECT status FROM slots WHERE slot = ?", (slot,)).fetchone()
+        return row is not None and row[0] == "done"
+
+    def unfinished_slots(self, since: float) -> list:
+        """返回指定时间之后触发、仍有群未发送的时间点: [(时间点, 提示词)]"""
+        return self._conn.execute(
+            "SELECT slot, prompt FROM slots WHERE status = 'running' AND fire_at >= ? ORDER BY fire_at",
+            (since,),
+        ).fetchall()
+
+    def pending_groups(self, slot: str) -> list:
+        return [row[0] for row in self._conn.execute(
+            "SELECT group_id FROM sends WHERE slot = ? AND status IN ('pending', 'claimed')",
+            (slot,),
+        )]
+
+    def compact(self, ttl_days: float):
+        """删除超过保留期的记录"""
+        cutoff = self.clock.time() - ttl_days * 86400
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("DELETE FROM sends WHERE slot IN (SELECT slot FROM slots WHERE updated < ?)", (cutoff,))
+            self._conn.execute("DELETE FROM slots WHERE updated < ?", (cutoff,))
+
+    def close(self):
+        self._conn.close()
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中日韩字符按每字1个token，其余字符按每4个1个token"""
+    cjk = sum(1 for ch in text if "\u2e80" <= ch <= "\u9fff" or "\uac00" <= ch <= "\ud7af" or "\uff00" <= ch <= "\uffef")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class ContextBuilder:
+    """从会话历史中取最近的消息构建LLM上下文
+
+    只解析历史JSON的尾部窗口，窗口内消息不足以填满预算时再逐步扩大；
+    结果按会话缓存，历史变化后才重新构建
+    """
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._decoder = json.JSONDecoder()
+
+    def build(self, history: str, token_budget: int = 0, max_messages: int = None, cache_key=None) -> list:
+        key = (cache_key, len(history), hash(history[-256:]), token_budget, max_messages)
+        contexts = self._cache.get(key)
+        if contexts is not None:
+            self._cache.move_to_end(key)
+            return contexts
+
+        contexts = self._build(history, token_budget, max_messages)
+        self._cache[key] = contexts
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return contexts
+
+    def _build(self, history: str, token_budget: int, max_messages: int) -> list:
+        if token_budget <= 0 and max_messages is None:
+            return json.loads(history)
+
+        # 中文在历史中可能被转义为\uXXXX，按每token约8个字符估计初始窗口
+        window = max(4096, token_budget * 8)
+        while True:
+            start = max(0, len(history) - window)
+            messages = self._parse_tail(history, start) if start else None
+            if messages is None:
+                start = 0
+                messages = json.loads(history)
+            contexts, truncated = self._trim(messages, token_budget, max_messages)
+            if truncated or start == 0:
+                return contexts
+            window *= 4
+
+    # 窗口内尝试作为消息起点的'{'的最大个数，超过后改为完整解析
+    MAX_TAIL_CANDIDATES = 64
+
+    def _parse_tail(self, history: str, start: int):
+        """从start之后的第一条完整消息解析到数组末尾，找不到时返回None
+
+        不依赖序列化格式（缩进、键顺序、ensure_ascii）：依次尝试窗口内的每个'{'，
+        能连续解析出带role的消息并正好结束于数组末尾的才算找到；内容中的'{'或嵌套对象会解析失败并被跳过
+        """
+        pos = history.find("{", start)
+        for _ in range(self.MAX_TAIL_CANDIDATES):
+            if pos < 0:
+                return None
+            messages = self._parse_messages(history, pos)
+            if messages is not None:
+                return messages
+            pos = history.find("{", pos + 1)
+        return None
+
+    def _parse_messages(self, history: str, pos: int):
+        """从pos开始解析以逗号分隔的消息直到数组末尾，结构不符合预期时返回None"""
+        messages = []
+        try:
+            while True:
+                message, pos = self._decoder.raw_decode(history, pos)
+                if not isinstance(message, dict) or "role" not in message:
+                    return None
+                messages.append(message)
+                while history[pos] in " \t\r\n":
+                    pos += 1
+                if history[pos] == "]":
+                    return messages if not history[pos + 1:].strip() else None
+                if history[pos] != ",":
+                    return None
+                pos += 1
+                while history[pos] in " \t\r\n":
+                    pos += 1
+        except (ValueError, IndexError):
+            return None
+
+    @staticmethod
+    def _message_tokens(message: dict) -> int:
+        content = message.get("content")
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        return estimate_tokens(content or "") + 4
+
+    def _trim(self, messages: list, token_budget: int, max_messages: int):
+        """从末尾保留预算内的消息，返回(上下文, 是否因预算或条数被截断)"""
+        kept = []
+        used = 0
+        truncated = False
+        for message in reversed(messages):
+            if max_messages is not None and len(kept) >= max_messages:
+                truncated = True
+                break
+            tokens = self._message_tokens(message)
+            if token_budget > 0 and used + tokens > token_budget:
+                truncated = True
+                break
+            kept.append(message)
+            used += tokens
+        kept.reverse()
+
+        # 上下文从用户消息开始，避免以孤立的助手回复或工具结果开头；
+        # 预算只够放下末尾的助手回复或工具结果时返回空上下文
+        while kept and kept[0].get("role") != "user":
+            kept.pop(0)
+        return kept, truncated
+
+
+class PlatformRouter:
+    """群到aiocqhttp平台实例的路由表
+
+    默认用一致性哈希把群分散到所有实例，实例增减时只有少量群会迁移；
+    group_routes 中显式指定的群优先；路由表按(实例列表, 群列表, 配置)缓存
+    """
+
+    VIRTUAL_NODES = 64
+
+    def __init__(self):
+        self._signature = None
+        self._routes = []
+
+    @staticmethod
+    def platform_key(platform) -> str:
+        """平台实例标识，多个OneBot账号各自独立"""
+        meta = platform.meta()
+        return getattr(meta, "id", None) or meta.name
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def _build_ring(self, keys: list) -> tuple:
+        ring = sorted((self._hash(f"{key}#{i}"), key) for key in keys for i in range(self.VIRTUAL_NODES))
+        return [point for point, _ in ring], [key for _, key in ring]
+
+    def route_groups(self, platforms: list, groups: list, shard_mode: str = "consistent_hash", explicit_routes: tuple = ()) -> list:
+        """返回 [(平台实例, 群列表)]，没有可用实例时返回空列表"""
+        instances = [p for p in platforms if p.meta().name == "aiocqhttp"]
+        signature = (
+            tuple(id(p) for p in instances),
+            tuple(str(g) for g in groups),
+            shard_mode,
+            tuple(explicit_routes),
+        )
+        if signature == self._signature:
+            return self._routes
+
+        routes = {}
+        if instances:
+            by_key = {self.platform_key(p): p for p in instances}
+            explicit = {}
+            for item in explicit_routes:
+                group_id, _, platform_id = str(item).partition(":")
+                if platform_id.strip() in by_key:
+                    explicit[group_id.strip()] = by_key[platform_id.strip()]
+                else:
+                    logger.warning(f"群路由 {item} 指向的平台实例不存在，改用默认路由")
+
+            points, owners = self._build_ring(list(by_key))
+            for group_id in groups:
+                platform = explicit.get(str(group_id))
+                if platform is None:
+                    if shard_mode == "first":
+                        platform = instances[0]
+                    else:
+                        i = bisect.bisect(points, self._hash(str(group_id))) % len(points)
+                        platform = by_key[owners[i]]
+                routes.setdefault(id(platform), (platform, []))[1].append(group_id)
+
+        self._signature = signature
+        self._routes = list(routes.values())
+        if len(self._routes) > 1:
+            logger.info("群路由: " + ", ".join(f"{self.platform_key(p)} {len(g)}个群" for p, g in self._routes))
+        return self._routes
+
+
+class WorkerCoordinator:
+    """多进程协调接口的单进程实现：只有本进程一个工作进程，所有群都归本进程发送
+
+    其他实现需要提供心跳、存活工作进程列表和退出登记；群按一致性哈希分配到存活的工作进程，
+    工作进程增减时只有少量群会迁移。分配只用于分摊发送，是否重复发送仍由账本的原子认领保证
+    """
+
+    VIRTUAL_NODES = 64
+
+    def __init__(self, worker_id: str, clock: SystemClock = None, ttl: float = 30):
+        self.worker_id = worker_id
+        self.clock = clock or SystemClock()
+        self.ttl = ttl
+        self._ring_signature = None
+        self._ring = ([], [])
+
+    def heartbeat(self):
+        """登记或续期本工作进程"""
+
+    def live_workers(self) -> list:
+        """心跳未过期的工作进程，按ID排序"""
+        return [self.worker_id]
+
+    def leave(self):
+        """注销本工作进程，其余进程立即接管它的群"""
+
+    def close(self):
+        pass
+
+    def _get_ring(self, workers: list) -> tuple:
+        signature = tuple(workers)
+        if signature != self._ring_signature:
+            ring = sorted((PlatformRouter._hash(f"{worker}#{i}"), worker) for worker in workers for i in range(self.VIRTUAL_NODES))
+            self._ring = ([point for point, _ in ring], [worker for _, worker in ring])
+            self._ring_signature = signature
+        return self._ring
+
+    def partition(self, groups: list) -> list:
+        """返回分配给本工作进程的群"""
+        workers = self.live_workers()
+        if self.worker_id not in workers:
+            workers = sorted(workers + [self.worker_id])
+        if len(workers) == 1:
+            return list(groups)
+        points, owners = self._get_ring(workers)
+        return [
+            group_id for group_id in groups
+            if owners[bisect.bisect(points, PlatformRouter._hash(str(group_id))) % len(points)] == self.worker_id
+        ]
+
+
+class SQLiteWorkerCoordinator(WorkerCoordinator):
+    """基于SQLite的工作进程协调，共享同一个数据库文件的多个AstrBot进程按心跳表分配群"""
+
+    def __init__(self, path: str, worker_id: str, clock: SystemClock = None, ttl: float = 30):
+        super().__init__(worker_id, clock, ttl)
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                started REAL NOT NULL,
+                heartbeat REAL NOT NULL
+            )
+        """)
+
+    def heartbeat(self):
+        now = self.clock.time()
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute(
+                "INSERT INTO workers (worker_id, started, heartbeat) VALUES (?, ?, ?) "
+                "ON CONFLICT(worker_id) DO UPDATE SET heartbeat = excluded.heartbeat",
+                (self.worker_id, now, now),
+            )
+            # 清理早已失联的工作进程
+            self._conn.execute("DELETE FROM workers WHERE heartbeat < ?", (now - 10 * self.ttl,))
+
+    def live_workers(self) -> list:
+        return [row[0] for row in self._conn.execute(
+            "SELECT worker_id FROM workers WHERE heartbeat >= ? ORDER BY worker_id",
+            (self.clock.time() - self.ttl,),
+        )]
+
+    def leave(self):
+        self._conn.execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+
+    def close(self):
+        self._conn.close()
+
+
+class PersonaResolver:
+    """人格与会话解析缓存
+
+    维护人格名称到提示词的索引：人格列表对象或长度变化时自动重建，配置重载和每个时间点开始时也会重建，
+    以便读到原地修改的人格提示词，查找本身只是字典访问；
+    定时发送时在时间点开始前批量解析所有群的当前会话，发送过程中只需查字典；
+    解析结果按时间点分别保存，同一分钟触发的多条规则并发发送时互不覆盖
+    """
+
+    MAX_SLOTS = 8
+
+    def __init__(self, context):
+        self.context = context
+        self._persona_signature = None
+        self._persona_prompts = {}
+        self._slot_conversations = OrderedDict()
+
+    @staticmethod
+    def _origin(group_id) -> str:
+        """构建一个虚拟的消息会话标识符"""
+        return f"aiocqhttp:GROUP_MESSAGE:{group_id}"
+
+    def _persona_index(self) -> dict:
+        """人格名称到提示词的索引，人格列表对象或长度变化时重建"""
+        personas = self.context.provider_manager.personas
+        signature = (id(personas), len(personas))
+        if signature != self._persona_signature:
+            self._persona_prompts = {persona.get("name"): persona.get("prompt", "") for persona in personas}
+            self._persona_signature = signature
+        return self._persona_prompts
+
+    def invalidate(self):
+        """人格或会话发生变化时清空缓存"""
+        self._persona_signature = None
+        self._slot_conversations.clear()
+
+    def personality_prompt(self, conversation, provider) -> str:
+        """根据会话的人格设置解析人格提示词"""
+        personality_prompt = ""
+        
+        # 从会话中获取人格ID
+        if conversation and hasattr(conversation, 'persona_id'):
+            persona_id = conversation.persona_id
+            
+            # 如果用户明确取消了人格
+            if persona_id == "[%None]":
+                personality_prompt = ""  # 用户明确取消了人格，使用空提示
+            # 如果用户设置了特定人格
+            elif persona_id:
+                personality_prompt = self._persona_index().get(persona_id, "")
+            # 如果没有设置人格（新会话），使用默认人格
+            else:
+                default_persona = self.context.provider_manager.selected_default_persona
+                if default_persona:
+                    personality_prompt = self._persona_index().get(default_persona.get("name"), "")
+        
+        # 如果上面的逻辑没有找到人格提示词，使用提供商的当前人格作为备选
+        if not personality_prompt and hasattr(provider, 'curr_personality') and provider.curr_personality:
+            personality_prompt = provider.curr_personality.get("prompt", "")
+        return personality_prompt
+
+    async def resolve(self, group_id):
+        """获取群的当前会话，没有会话时创建一个新的"""
+        conversation_manager = self.context.conversation_manager
+        unified_msg_origin = self._origin(group_id)
+        curr_cid = await conversation_manager.get_curr_conversation_id(unified_msg_origin)
+        if not curr_cid:
+            curr_cid = await conversation_manager.new_conversation(unified_msg_origin)
+        return await conversation_manager.get_conversation(unified_msg_origin, curr_cid)
+
+    async def prefetch(self, slot_key: str, groups: list):
+        """时间点开始时并发解析所有群的会话，已解析过的群不再重复解析"""
+        cached = self._slot_conversations.get(slot_key)
+        if cached is None:
+            # 新的时间点重建一次人格索引
+            self._persona_signature = None
+            cached = self._slot_conversations[slot_key] = {}
+            while len(self._slot_conversations) > self.MAX_SLOTS:
+                self._slot_conversations.popitem(last=False)
+        missing = [group_id for group_id in groups if str(group_id) not in cached]
+        if not missing:
+            return
+        conversations = await asyncio.gather(*(self.resolve(group_id) for group_id in missing), return_exceptions=True)
+        for group_id, conversation in zip(missing, conversations):
+            if not isinstance(conversation, BaseException):
+                cached[str(group_id)] = conversation
+
+    async def get_conversation(self, group_id, slot_key: str = None):
+        """获取群的会话，命中该时间点批量解析的结果时不再访问会话管理器"""
+        if slot_key is not None and slot_key in self._slot_conversations:
+            conversation = self._slot_conversations[slot_key].get(str(group_id))
+            if conversation is not None:
+                return conversation
+        return await self.resolve(group_id)
+
+
+def _parse_cron_field(field: str, low: int, high: int):
+    """解析cron的一个字段，支持 * a-b a,b */n a-b/n，返回取值集合，*返回None"""
+    if field == "*":
+        return None
+    values = set()
+    for part in field.split(","):
+        value_range, _, step = part.partition("/")
+        step = int(step) if step else 1
+        if value_range == "*":
+            start, end = low, high
+        elif "-" in value_range:
+            start, end = (int(x) for x in value_range.split("-", 1))
+        else:
+            start = int(value_range)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError(f"取值超出范围 {low}-{high}: {part}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def _parse_date_range(text: str) -> tuple:
+    """解析 2024-10-01~2024-10-07 或单个日期"""
+    start, _, end = text.partition("~")
+    start_date = datetime.date.fromisoformat(start.strip())
+    end_date = datetime.date.fromisoformat(end.strip()) if end.strip() else start_date
+    return start_date, end_date
+
+
+@dataclass(frozen=True)
+class ScheduleRule:
+    """一条发送规则：每周的触发时刻，加上提示词、目标群和排除日期"""
+    key: str
+    minutes: tuple
+    hours: tuple
+    weekdays: frozenset = None  # 0-6，0表示周一；None表示不限
+    days: frozenset = None  # 每月几号；None表示不限
+    months: frozenset = None
+    prompt: str = ""
+    groups: tuple = None  # None表示所有启用的群
+    exclusions: tuple = ()  # ((开始日期, 结束日期), ...)
+
+    @classmethod
+    def parse(cls, key: str, text: str) -> "ScheduleRule":
+        """解析规则: 分 时 日 月 周 | 提示词 | 群号,群号 | 排除日期,排除日期
+
+        周字段与cron一致，0和7表示周日；后三段可省略，群号留空表示所有启用的群
+        """
+        parts = [part.strip() for part in text.split("|")]
+        fields = parts[0].split()
+        if len(fields) != 5:
+            raise ValueError("cron表达式需要5个字段: 分 时 日 月 周")
+        minute, hour, day, month, weekday = fields
+
+        weekdays = _parse_cron_field(weekday, 0, 7)
+        if weekdays is not None:
+            weekdays = frozenset((value - 1) % 7 for value in weekdays)
+        days = _parse_cron_field(day, 1, 31)
+        months = _parse_cron_field(month, 1, 12)
+        groups = [g.strip() for g in parts[2].split(",") if g.strip()] if len(parts) > 2 else []
+        exclusions = [_parse_date_range(x) for x in parts[3].split(",") if x.strip()] if len(parts) > 3 else []
+
+        return cls(
+            key=key,
+            minutes=tuple(sorted(_parse_cron_field(minute, 0, 59) or range(60))),
+            hours=tuple(sorted(_parse_cron_field(hour, 0, 23) or range(24))),
+            weekdays=weekdays,
+            days=frozenset(days) if days is not None else None,
+            months=frozenset(months) if months is not None else None,
+            prompt=parts[1] if len(parts) > 1 and parts[1] else "请以你的风格写一段吸引人的KFC推销文案。",
+            groups=tuple(groups) or None,
+            exclusions=tuple(exclusions),
+        )
+
+    def index_weekdays(self) -> frozenset:
+        """需要写入每周索引的星期；限制了日期时逐日检查"""
+        if self.weekdays is None or self.days is not None:
+            return frozenset(range(7))
+        return self.weekdays
+
+    def matches_date(self, date: datetime.date) -> bool:
+        """检查月份、日期和排除日期（星期已由索引保证）"""
+        if self.months is not None and date.month not in self.months:
+            return False
+        if any(start <= date <= end for start, end in self.exclusions):
+            return False
+        if self.days is None:
+            return True
+        if self.weekdays is None:
+            return date.day in self.days
+        # 与cron一致：日和星期同时限制时满足其一即可
+        return date.day in self.days or date.weekday() in self.weekdays
+
+
+class ScheduleIndex:
+    """把规则编译为按“周内分钟”排序的触发索引，二分查找下一次触发"""
+
+    # 找不到满足日期条件的触发点时最多向后查找的天数
+    LOOKAHEAD_DAYS = 400
+
+    def __init__(self, rules: list):
+        self.rules = rules
+        entries = set()
+        for order, rule in enumerate(rules):
+            for weekday in rule.index_weekdays():
+                for hour in rule.hours:
+                    for minute in rule.minutes:
+                        entries.add((weekday * 1440 + hour * 60 + minute, order))
+        self._entries = sorted(entries)
+        self._minutes = [minute_of_week for minute_of_week, _ in self._entries]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def next_fire(self, now: datetime.datetime):
+        """返回不早于当前分钟的下一次触发时间及该分钟触发的规则（按优先级升序）"""
+        if not self._entries:
+            return None, []
+        current = now.replace(second=0, microsecond=0)
+        week_start = (current - datetime.timedelta(days=current.weekday())).replace(hour=0, minute=0)
+        limit = current + datetime.timedelta(days=self.LOOKAHEAD_DAYS)
+        i = bisect.bisect_left(self._minutes, (current - week_start) // datetime.timedelta(minutes=1))
+
+        while True:
+            if i == len(self._entries):
+                i = 0
+                week_start += datetime.timedelta(days=7)
+            minute_of_week = self._minutes[i]
+            fire_at = week_start + datetime.timedelta(minutes=minute_of_week)
+            if fire_at > limit:
+                return None, []
+
+            rules = []
+            while i < len(self._entries) and self._minutes[i] == minute_of_week:
+                rule = self.rules[self._entries[i][1]]
+                if rule.matches_date(fire_at.date()):
+                    rules.append(rule)
+                i += 1
+            if rules:
+                return fire_at, rules
+
+    def upcoming(self, now: datetime.datetime, count: int) -> list:
+        """接下来的count次触发: [(触发时间, 规则列表)]"""
+        fires = []
+        fire_at, rules = self.next_fire(now)
+        while fire_at is not None and len(fires) < count:
+            fires.append((fire_at, rules))
+            fire_at, rules = self.next_fire(fire_at + datetime.timedelta(minutes=1))
+        return fires
+
+
+@dataclass(frozen=True)
+class CompiledConfig:
+    """由配置编译出的只读视图，热路径只读取它；配置变化时整体替换，不在每次使用时解析配置"""
+
+    fingerprint: str
+    enabled_groups: tuple
+    enabled_group_set: frozenset
+    time_prompts: dict  # 预设时间 -> 提示词，例如 "10:00" -> "..."
+    presets: tuple  # ((时间, 是否启用), ...)
+    custom_time: tuple  # (是否启用, 星期1-7, 时, 分)，未配置时为None
+    rules: tuple
+    index: ScheduleIndex
+    custom_prompt: str
+    status_upcoming_count: int
+    config_watch_interval: float
+    # 发送
+    shard_mode: str
+    group_routes: tuple
+    send_concurrency: int
+    send_rate_per_second: float
+    send_rate_burst: int
+    pregenerate_lead_minutes: float
+    ledger_ttl_days: float
+    retry_max_attempts: int
+    retry_base_delay_seconds: float
+    retry_deadline_seconds: float
+    metrics_dump_path: str
+    # 文案生成
+    context_mode: str
+    context_last_k: int
+    context_token_budget: int
+    per_group_generation: bool
+    llm_retry_count: int
+    llm_call_timeout_seconds: float
+    llm_stream_idle_seconds: float
+    llm_streaming: bool
+    llm_slot_timeout_seconds: float
+    # /kfc 文案池与限流
+    copy_pool_size: int
+    copy_pool_low_water: int
+    copy_pool_similarity: float
+    copy_pool_llm_calls_per_hour: int
+    kfc_group_per_minute: float
+    kfc_user_per_minute: float
+
+    @staticmethod
+    def fingerprint_of(config) -> str:
+        return json.dumps(dict(config), sort_keys=True, ensure_ascii=False, default=str)
+
+    @classmethod
+    def compile(cls, config, fingerprint: str = None) -> "CompiledConfig":
+        """编译配置，发送规则的顺序为：自定义时间点、星期四预设时间点、schedule_rules中的规则
+
+        同一分钟同一个群只发送优先级最高（靠后）的规则
+        """
+        enabled_groups = tuple(str(group_id) for group_id in config.get("enabled_groups", []) or [])
+        rules = []
+
+        custom_times = config.get("custom_times", {}) or {}
+        custom_time = None
+        if custom_times:
+            custom_time = (
+                custom_times.get("enabled", True),
+                custom_times.get("weekday", 4),
+                custom_times.get("hour", 18),
+                custom_times.get("minute", 30),
+            )
+        if custom_times.get("enabled", True):
+            rules.append(ScheduleRule(
+                key="custom",
+                minutes=(custom_times.get("minute", 30),),
+                hours=(custom_times.get("hour", 18),),
+                weekdays=frozenset({custom_times.get("weekday", 4) - 1}),
+                prompt=custom_times.get("prompt", "请以你的风格写一段吸引人的KFC推销文案。"),
+            ))
+
+        time_prompts = {}
+        presets = []
+        for key, time_str, enabled_key in PRESET_SLOTS:
+            time_prompts[time_str] = config.get(f"{key}_prompt", PRESET_PROMPTS[key])
+            enabled = bool(config.get(enabled_key, True))
+            presets.append((time_str, enabled))
+            if not enabled:
+                continue
+            hour, minute = (int(x) for x in time_str.split(":"))
+            rules.append(ScheduleRule(
+                key=key, minutes=(minute,), hours=(hour,), weekdays=frozenset({3}), prompt=time_prompts[time_str],
+            ))
+
+        for i, text in enumerate(config.get("schedule_rules", []) or []):
+            try:
+                rules.append(ScheduleRule.parse(f"rule{i + 1}", text))
+            except Exception as e:
+                logger.error(f"发送规则 {i + 1} 格式错误，已忽略: {text}（{e}）")
+
+        context_mode = config.get("context_mode", "none")
+
+        return cls(
+            fingerprint=fingerprint or cls.fingerprint_of(config),
+            enabled_groups=enabled_groups,
+            enabled_group_set=frozenset(enabled_groups),
+            time_prompts=time_prompts,
+            presets=tuple(presets),
+            custom_time=custom_time,
+            rules=tuple(rules),
+            index=ScheduleIndex(rules),
+            custom_prompt=config.get("custom_prompt", "今天是KFC疯狂星期X，请你写一段有创意的肯德基推销文案，让人们想要购买肯德基。"),
+            status_upcoming_count=int(config.get("status_upcoming_count", 5)),
+            config_watch_interval=float(config.get("config_watch_interval", 3600)),
+            shard_mode=config.get("shard_mode", "consistent_hash"),
+            group_routes=tuple(config.get("group_routes", []) or []),
+            send_concurrency=max(1, int(config.get("send_concurrency", 5))),
+            send_rate_per_second=float(config.get("send_rate_per_second", 1.0)),
+            send_rate_burst=int(config.get("send_rate_burst", 3)),
+            pregenerate_lead_minutes=float(config.get("pregenerate_lead_minutes", 10)),
+            ledger_ttl_days=float(config.get("ledger_ttl_days", 7)),
+            retry_max_attempts=max(0, int(config.get("retry_max_attempts", 4))),
+            retry_base_delay_seconds=float(config.get("retry_base_delay_seconds", 2)),
+            retry_deadline_seconds=float(config.get("retry_deadline_seconds", 600)),
+            metrics_dump_path=config.get("metrics_dump_path", ""),
+            context_mode=context_mode,
+            context_last_k=int(config.get("context_last_k", 10)),
+            context_token_budget=int(config.get("context_token_budget", 2000)),
+            per_group_generation=context_mode != "none" or bool(config.get("per_group_variation", False)),
+            llm_retry_count=max(0, int(config.get("llm_retry_count", 1))),
+            llm_call_timeout_seconds=float(config.get("llm_call_timeout_seconds", 30)),
+            llm_stream_idle_seconds=float(config.get("llm_stream_idle_seconds", 10)),
+            llm_streaming=bool(config.get("llm_streaming", True)),
+            llm_slot_timeout_seconds=float(config.get("llm_slot_timeout_seconds", 90)),
+            copy_pool_size=max(1, int(config.get("copy_pool_size", 8))),
+            copy_pool_low_water=int(config.get("copy_pool_low_water", 3)),
+            copy_pool_similarity=float(config.get("copy_pool_similarity", 0.6)),
+            copy_pool_llm_calls_per_hour=max(1, int(config.get("copy_pool_llm_calls_per_hour", 30))),
+            kfc_group_per_minute=float(config.get("kfc_group_per_minute", 3)),
+            kfc_user_per_minute=float(config.get("kfc_user_per_minute", 1)),
+        )
+
 
 @register(
     "astrbot_plugin_kfc_thursday",
@@ -18,397 +1452,891 @@ import time
     "https://github.com/0d00-Ciallo-0721/astrbot_plugin_kfc_thursday",
 )
 class KFCThursdayPlugin(Star):
-    def __init__(self, context: Context, config: AstrBotConfig):
+    def __init__(self, context: Context, config: AstrBotConfig, clock: SystemClock = None, dry_run: bool = False):
         super().__init__(context)
         self.config = config
         
-        # 从配置文件加载配置
-        self.enabled_groups = config.get("enabled_groups", [])
+        # 时钟，模拟运行时使用虚拟时钟；dry_run时只记录发送，不调用LLM和平台接口
+        self._clock = clock or SystemClock()
+        self._dry_run = dry_run
+        self._dry_run_sends = []
         
-        # 时间点及对应的提示词
-        self.time_prompts = {
-            "10:00": config.get("morning_prompt", "请你以撒娇的语气，写一段请求对方转账50元的消息。你非常想吃KFC，而今天是疯狂星期四，特地想用可爱的方式让对方给你转账。。"),
-            "12:00": config.get("noon_prompt", "请你以可怜的语气，写一段请求对方转账50元的消息。你特别想吃KFC，但钱包空空，今天又是疯狂星期四，希望通过可怜的方式让对方转账。"),
-            "18:00": config.get("evening_prompt", "你以搞笑的语气，写一段请求对方转账50元的消息。你特别想吃KFC，而今天是疯狂星期四，用幽默风趣的方式让对方给你转账。"),
-            "20:00": config.get("night_prompt", "请你以卖萌的语气，写一段请求对方转账50元的消息。你超级想吃KFC，今天是疯狂星期四，用萌萌的语气请求对方转账。")
-        }
+        # 从配置编译只读视图：启用的群、时间点提示词、发送规则和各项运行参数
+        self._view = CompiledConfig.compile(config)
+        self._config_mtime = self._config_file_mtime()
+        logger.info(f"已编译 {len(self._view.rules)} 条发送规则，共 {len(self._view.index)} 个每周触发点")
         
         # 收款码图片路径
         self.payment_qrcode_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "收款码.jpg")
-        if not os.path.exists(self.payment_qrcode_path):
-            logger.warning(f"收款码图片不存在: {self.payment_qrcode_path}")
+        self._qrcode = QRCodeAsset(self.payment_qrcode_path)
+        self._qrcode.refresh()
         
-        # 检查是否需要启动定时任务
-        self.check_and_start_scheduler()
+        # 插件持有的任务: 名称 -> Task
+        self._tasks = {}
+        self._schedule_changed = asyncio.Event()
         
-        # 创建日常检查任务
-        asyncio.create_task(self.daily_scheduler())
-
-        logger.info("KFC星期四插件已初始化完成！")
-
-    def check_and_start_scheduler(self):
-        """检查是否需要启动定时任务"""
-        now = datetime.datetime.now()
-        current_weekday = now.weekday()  # 0-6，0表示周一
+        # 按平台区分的发送限流器
+        self._rate_limiters = {}
+        
+        # 按(时间点, 提示词, 人格)缓存的生成结果，以及按(提示词, 人格)记录的最近一次生成结果
+        self._generation_cache = GenerationCache(clock=self._clock)
+        self._last_completions = {}
+        # dry_run时预生成文案和死信列表与账本一样只保存在内存中，不会改动正在运行的插件的文件
+        plugin_dir = os.path.dirname(os.path.abspath(__file__))
+        self._pregenerated = PregeneratedStore(None if dry_run else os.path.join(plugin_dir, "pregenerated.json"))
+        
+        # /kfc 使用的按人格区分的文案池、后台补充的LLM调用预算，以及按群和按用户的限流器
+        self._copy_pool = CopyPool(self._view.copy_pool_similarity)
+        self._copy_pool_budget = None
+        self._command_limiters = None
+        
+        # 发送链路指标
+        self._metrics = KFCMetrics(int(config.get("metrics_buffer_size", 2048)))
         
-        # 检查自定义时间设置是否有今天的任务
-        custom_times = self.config.get("custom_times", {})
-        custom_weekday = custom_times.get("weekday", 4) - 1  # 转为0-6
+        # 群到平台实例的路由表
+        self._platform_router = PlatformRouter()
         
-        # 如果今天是星期四或是自定义的日期，启动定时任务
-        if current_weekday == 3 or current_weekday == custom_weekday:
-            logger.info(f"今天是星期{current_weekday + 1}，{'是星期四' if current_weekday == 3 else '匹配自定义日期'}，启动KFC活动定时任务")
-            asyncio.create_task(self.schedule_kfc_posts())
+        # 按会话缓存裁剪后的上下文
+        self._context_builder = ContextBuilder()
+        
+        # 人格与会话解析缓存
+        self._persona_resolver = PersonaResolver(context)
+        
+        # 重试失败的群
+        self._dead_letters = DeadLetterStore(None if dry_run else os.path.join(plugin_dir, "dead_letters.json"))
+        
+        # 发送记录账本，每个群发送前原子认领
+        ledger_path = ":memory:" if dry_run else os.path.join(plugin_dir, "kfc_ledger.db")
+        # 多个AstrBot进程共享账本时，按心跳表把群分配到各个存活的进程；
+        # 认领有效期必须长于心跳过期时间，否则存活进程正在发送的群可能被其他进程接管
+        heartbeat_interval = max(1.0, float(config.get("worker_heartbeat_seconds", 10)))
+        claim_ttl = float(config.get("ledger_claim_ttl_seconds", 300))
+        if claim_ttl <= 3 * heartbeat_interval:
+            logger.warning(f"ledger_claim_ttl_seconds（{claim_ttl:g}）必须大于心跳过期时间（{3 * heartbeat_interval:g}秒），已改为 {6 * heartbeat_interval:g} 秒")
+            claim_ttl = 6 * heartbeat_interval
+        self._ledger = SendLedger(ledger_path, claim_ttl=claim_ttl, clock=self._clock)
+        
+        if dry_run:
+            self._coordinator = WorkerCoordinator(self._ledger.owner, self._clock)
         else:
-            logger.info(f"今天是星期{current_weekday + 1}，不需要启动KFC活动定时任务")
-            # 计算到下一个可能有任务的日期
-            next_task_days = 7  # 默认一周后再检查
-            
-            # 计算到星期四的天数
-            days_to_thursday = (3 - current_weekday) % 7
-            if days_to_thursday == 0:  # 如果今天是星期四但已经错过了时间
-                days_to_thursday = 7
-                
-            # 计算到自定义日期的天数
-            days_to_custom = (custom_weekday - current_weekday) % 7
-            if days_to_custom == 0:  # 如果今天是自定义日期但已经错过了时间
-                days_to_custom = 7
-                
-            # 取最小值
-            next_task_days = min(days_to_thursday, days_to_custom)
-            
-            next_check = now + datetime.timedelta(days=next_task_days)
-            next_check = next_check.replace(hour=0, minute=0, second=0, microsecond=0)
-            
-            seconds_until_next_check = (next_check - now).total_seconds()
-            logger.info(f"将在{next_task_days}天后（{next_check.strftime('%Y-%m-%d')}）检查并启动KFC活动")
-            
-            # 设置定时器，到下一个可能有任务的日期时再次检查
-            asyncio.create_task(self.wait_for_next_check(seconds_until_next_check))
+            self._coordinator = SQLiteWorkerCoordinator(ledger_path, self._ledger.owner, self._clock, ttl=3 * heartbeat_interval)
+            self._coordinator.heartbeat()
+            self._spawn("heartbeat", self._heartbeat(heartbeat_interval))
+        
+        # 启动守护任务，由它运行唯一的定时任务
+        self._spawn("supervisor", self._supervise())
+
+        logger.info("KFC星期四插件已初始化完成！")
+
+    def _spawn(self, name: str, coro) -> asyncio.Task:
+        """创建由插件持有的任务并登记，任务结束后自动注销，插件卸载时统一取消"""
+        task = asyncio.create_task(coro, name=f"kfc:{name}")
+        self._tasks[name] = task
+
+        def unregister(finished):
+            if self._tasks.get(name) is finished:
+                del self._tasks[name]
+
+        task.add_done_callback(unregister)
+        return task
 
-    async def daily_scheduler(self):
-        """每天凌晨检查是否需要启动任务"""
+    def _spawn_background(self, name: str, coro) -> asyncio.Task:
+        """创建一次性的后台任务，同名任务仍在运行时不会重复创建"""
+        running = self._tasks.get(name)
+        if running and not running.done():
+            coro.close()
+            return running
+        return self._spawn(name, coro)
+
+    async def _supervise(self):
+        """守护定时任务：每个进程只运行一个调度循环，异常退出时重新启动"""
         while True:
-            # 计算到下一个凌晨的时间
-            now = datetime.datetime.now()
-            tomorrow = now.replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
-            sleep_seconds = (tomorrow - now).total_seconds()
-            
-            # 等到凌晨
-            await asyncio.sleep(sleep_seconds)
-            
-            # 检查是否需要启动任务
-            self.check_and_start_scheduler()
+            next_fire, rules = self._get_schedule_index().next_fire(self._clock.now())
+            if next_fire is not None:
+                logger.info(f"启动KFC活动定时任务，下一个发送时间点: {next_fire.strftime('%Y-%m-%d %H:%M')}（{', '.join(rule.key for rule in rules)}）")
+            else:
+                logger.info("当前没有启用的发送时间点，定时任务将等待配置变化")
 
-    async def wait_for_next_check(self, seconds):
-        """等待到下一个检查日期"""
-        await asyncio.sleep(seconds)
-        self.check_and_start_scheduler()
+            try:
+                await self._spawn("scheduler", self.schedule_kfc_posts())
+                logger.warning("KFC定时任务意外结束，60秒后重新启动")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"KFC定时任务异常退出，60秒后重新启动: {e}")
+            self._metrics.incr("scheduler_restart")
+            await self._clock.sleep(60)
 
-    async def schedule_kfc_posts(self):
-        """定时任务，在指定时间发送KFC文案"""
-        # 创建锁文件路径
-        lock_file_path = os.path.join(os.path.dirname(__file__), "kfc_sending.lock")
-        processed_file_path = os.path.join(os.path.dirname(__file__), "processed_times.txt")
-        
-        # 加载已处理的时间点
-        processed_times = set()
-        if os.path.exists(processed_file_path):
+    def health(self) -> dict:
+        """插件持有的任务及其状态"""
+        return {name: ("运行中" if not task.done() else "已结束") for name, task in self._tasks.items()}
+
+    async def terminate(self):
+        """插件卸载或重载时取消所有任务并关闭账本"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            self._coordinator.leave()
+        except Exception as e:
+            logger.warning(f"注销工作进程失败: {e}")
+        self._coordinator.close()
+        self._pregenerated.flush()
+        self._ledger.close()
+        logger.info(f"KFC星期四插件已停止，取消了 {len(tasks)} 个任务")
+
+    @property
+    def enabled_groups(self) -> tuple:
+        return self._view.enabled_groups
+
+    @property
+    def time_prompts(self) -> dict:
+        return self._view.time_prompts
+
+    def _get_schedule_index(self) -> ScheduleIndex:
+        return self._view.index
+
+    def reload_config(self) -> bool:
+        """配置有变化时重新编译只读视图并立即生效，返回是否有变化"""
+        fingerprint = CompiledConfig.fingerprint_of(self.config)
+        if fingerprint == self._view.fingerprint:
+            return False
+        previous, self._view = self._view, CompiledConfig.compile(self.config, fingerprint)
+        # 限流参数可能变化，按新配置重建限流器；人格和会话缓存也一并清空
+        self._rate_limiters.clear()
+        self._persona_resolver.invalidate()
+        self._copy_pool_budget = None
+        self._command_limiters = None
+        if previous.time_prompts != self._view.time_prompts:
+            self._copy_pool.clear()
+        self._copy_pool.similarity = self._view.copy_pool_similarity
+        logger.info(f"配置已更新，已编译 {len(self._view.rules)} 条发送规则，共 {len(self._view.index)} 个每周触发点，启用 {len(self._view.enabled_groups)} 个群")
+        if previous.rules != self._view.rules:
+            self.reschedule()
+        return True
+
+    def _reload_config_file(self, path: str):
+        """配置文件被直接修改时，把文件内容读回内存中的配置"""
+        try:
+            with open(path, "r", encoding="utf-8-sig") as f:
+                self.config.update(json.load(f))
+        except Exception as e:
+            logger.warning(f"读取配置文件失败: {e}")
+
+    def _config_file_mtime(self):
+        config_path = getattr(self.config, "config_path", None)
+        if not config_path:
+            return None
+        try:
+            return os.path.getmtime(config_path)
+        except OSError:
+            return None
+
+    def _check_config_file(self) -> bool:
+        """配置文件的修改时间变化时读回配置并重新编译，返回配置是否有变化
+
+        在管理面板保存配置时AstrBot会重载插件，这里只处理直接修改配置文件的情况；平时只比较修改时间，不解析配置
+        """
+        mtime = self._config_file_mtime()
+        if mtime is None or mtime == self._config_mtime:
+            return False
+        self._config_mtime = mtime
+        self._reload_config_file(self.config.config_path)
+        return self.reload_config()
+
+    async def _heartbeat(self, interval: float):
+        """定期续期本进程的心跳，心跳过期的进程的群会被其他进程接管"""
+        while True:
+            await self._clock.sleep(interval)
             try:
-                with open(processed_file_path, "r") as f:
-                    processed_times = set(line.strip() for line in f.readlines())
-            except:
-                pass
+                self._coordinator.heartbeat()
+            except Exception as e:
+                logger.error(f"更新工作进程心跳失败: {e}")
+
+    def _assign_groups(self, rules: list) -> list:
+        """把同一分钟触发的规则分配到群，每个群只归属优先级最高的规则: [(规则, 群列表)]"""
+        owner = {}
+        for rule in rules:
+            for group_id in rule.groups or self.enabled_groups:
+                owner[str(group_id)] = rule
+        return [(rule, [g for g, r in owner.items() if r is rule]) for rule in rules if rule in owner.values()]
+
+    def _next_prewarm(self, index: ScheduleIndex, base: datetime.datetime, prewarmed: set):
+        """下一个尚未预生成的触发点: (预生成时间, 触发时间, 规则列表)，关闭预生成时返回None"""
+        lead_minutes = self._view.pregenerate_lead_minutes
+        if lead_minutes <= 0:
+            return None
+        fire_at, rules = index.next_fire(base)
+        while fire_at is not None and fire_at in prewarmed:
+            fire_at, rules = index.next_fire(fire_at + datetime.timedelta(minutes=1))
+        if fire_at is None:
+            return None
+        return fire_at - datetime.timedelta(minutes=lead_minutes), fire_at, rules
+
+    @staticmethod
+    def _slot_time_key(fire_at: datetime.datetime, rule: ScheduleRule) -> str:
+        """时间点标识，例如 2024-01-04_12:00#noon"""
+        return f"{fire_at.strftime('%Y-%m-%d')}_{fire_at.hour:02d}:{fire_at.minute:02d}#{rule.key}"
+
+    async def _prewarm_slot(self, time_key: str, prompt: str, groups: list):
+        """在发送前为时间点预生成文案，结果写入磁盘队列，发送时只需执行发送"""
+        if self._dry_run:
+            self._metrics.incr("prewarm")
+            return
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(self._view.send_concurrency)
+        await self._persona_resolver.prefetch(time_key, groups)
+
+        async def worker(group_id):
+            async with semaphore:
+                await self.get_llm_kfc_content(prompt, group_id, time_key)
+
+        try:
+            await asyncio.gather(*(worker(group_id) for group_id in groups))
+        finally:
+            # 整个时间点生成完后一次性写盘
+            self._pregenerated.flush()
+        logger.info(f"时间点 {time_key} 文案预生成完成，耗时 {time.monotonic() - started:.2f} 秒")
+
+    def reschedule(self):
+        """唤醒定时任务并重新计算触发时间"""
+        self._schedule_changed.set()
+
+    async def schedule_kfc_posts(self):
+        """定时任务，休眠到最早的发送时间点再发送KFC文案"""
+        # 清理过期记录，并补发崩溃前未发送完的时间点
+        self._ledger.compact(self._view.ledger_ttl_days)
+        self._spawn_background("resume", self._resume_unfinished_slots())
+
+        prewarmed = set()
+        cursor = self._clock.now()
         
         while True:
             try:
-                # 检查锁文件是否存在
-                if os.path.exists(lock_file_path):
-                    # 如果锁文件存在，检查是否过期（超过3分钟判定为过期）
-                    lock_time = os.path.getmtime(lock_file_path)
-                    if time.time() - lock_time < 180:  # 3分钟锁
-                        # 锁未过期，等待
-                        await asyncio.sleep(60)
+                index = self._get_schedule_index()
+                now = self._clock.now()
+                base = max(cursor, now - datetime.timedelta(seconds=MAX_FIRE_LAG))
+                fire_at, rules = index.next_fire(base)
+                prewarm = self._next_prewarm(index, base, prewarmed)
+
+                # 休眠到最早的触发时间或预生成时间，配置变化时可被提前唤醒；
+                # 有配置文件时最多休眠config_watch_interval秒，醒来检查一次配置文件的修改时间
+                wake_times = [t for t in (fire_at, prewarm and prewarm[0]) if t is not None]
+                delay = (min(wake_times) - now).total_seconds() if wake_times else None
+                watch_interval = self._view.config_watch_interval
+                if watch_interval > 0 and self._config_mtime is not None and (delay is None or delay > watch_interval):
+                    delay = watch_interval
+                if delay is None or delay > 0:
+                    self._schedule_changed.clear()
+                    woken_by_change = await self._clock.wait(self._schedule_changed, delay)
+                    self._metrics.incr("scheduler_wakeup")
+                    if woken_by_change or self._check_config_file():
+                        # 配置变化，重新计算触发时间
                         continue
-                    else:
-                        # 锁过期，删除
-                        try:
-                            os.remove(lock_file_path)
-                        except:
-                            pass
-                
-                # 获取当前时间
-                now = datetime.datetime.now()
-                today_str = now.strftime("%Y-%m-%d")
-                current_weekday = now.weekday()
-                current_hour = now.hour
-                current_minute = now.minute
-                
-                # 时间标识
-                time_key = f"{today_str}_{current_hour:02d}:{current_minute:02d}"
-                
-                # 如果已处理过这个时间点，跳过
-                if time_key in processed_times:
-                    await asyncio.sleep(60)
+
+                now = self._clock.now()
+
+                # 到达预生成时间的时间点，在后台提前生成文案
+                if prewarm and prewarm[0] <= now:
+                    _, prewarm_fire_at, prewarm_rules = prewarm
+                    prewarmed.add(prewarm_fire_at)
+                    for rule, groups in self._assign_groups(prewarm_rules):
+                        time_key = self._slot_time_key(prewarm_fire_at, rule)
+                        own_groups = self._coordinator.partition(groups)
+                        if own_groups:
+                            self._spawn_background(f"prewarm:{time_key}", self._prewarm_slot(time_key, rule.prompt, own_groups))
+
+                if fire_at is None or fire_at > now:
+                    continue
+
+                cursor = fire_at + datetime.timedelta(minutes=1)
+                prewarmed = {t for t in prewarmed if t > fire_at}
+
+                lag = (now - fire_at).total_seconds()
+                if lag > MAX_FIRE_LAG:
+                    logger.warning(f"时间点 {fire_at.strftime('%Y-%m-%d %H:%M')} 已错过 {lag:.0f} 秒，跳过本次发送")
                     continue
-                
-                # 检查是否是发送时间点
-                should_send = False
-                prompt_to_use = None
-                
-                # 自定义时间检查
-                custom_times = self.config.get("custom_times", {})
-                custom_enabled = custom_times.get("enabled", True)
-                custom_weekday = custom_times.get("weekday", 4) - 1
-                custom_hour = custom_times.get("hour", 18) 
-                custom_minute = custom_times.get("minute", 30)
-                
-                if (custom_enabled and 
-                    current_weekday == custom_weekday and 
-                    current_hour == custom_hour and 
-                    current_minute == custom_minute):
+
+                logger.info(f"时间点匹配: 星期{fire_at.weekday() + 1} {fire_at.hour:02d}:{fire_at.minute:02d}（{', '.join(rule.key for rule in rules)}），延迟 {lag:.3f} 秒")
+                self._metrics.observe("slot_lag", lag, slot=self._slot_time_key(fire_at, rules[-1]))
+
+                # 同一分钟匹配多条规则时，每个群只发送优先级最高的规则
+                broadcasts = []
+                for rule, groups in self._assign_groups(rules):
+                    time_key = self._slot_time_key(fire_at, rule)
                     
-                    should_send = True
-                    prompt_to_use = custom_times.get("prompt", "请以你的风格写一段吸引人的KFC推销文案。")
-                    logger.info(f"自定义时间点匹配: 星期{current_weekday + 1} {current_hour:02d}:{current_minute:02d}")
-                
-                # 检查星期四预设时间
-                time_str = f"{current_hour:02d}:{current_minute:02d}"
-                if current_weekday == 3 and time_str in self.time_prompts:
-                    # 检查时间点是否启用
-                    is_enabled = False
-                    if time_str == "10:00":
-                        is_enabled = self.config.get("morning_enabled", True)
-                    elif time_str == "12:00":
-                        is_enabled = self.config.get("noon_enabled", True)
-                    elif time_str == "18:00":
-                        is_enabled = self.config.get("evening_enabled", True)
-                    elif time_str == "20:00":
-                        is_enabled = self.config.get("night_enabled", True)
+                    # 如果已处理过这个时间点，跳过
+                    if self._ledger.is_slot_done(time_key):
+                        continue
                     
-                    if is_enabled:
-                        should_send = True
-                        prompt_to_use = self.time_prompts[time_str]
-                        logger.info(f"预设时间点匹配: 星期四 {time_str}")
-                
-                # 如果需要发送
-                if should_send and prompt_to_use:
-                    # 创建锁文件
-                    try:
-                        with open(lock_file_path, "w") as f:
-                            f.write(f"KFC sending at {time_key}")
-                        
-                        # 记录此时间点已处理
-                        processed_times.add(time_key)
-                        with open(processed_file_path, "a") as f:
-                            f.write(f"{time_key}\n")
-                        
-                        logger.info(f"创建锁文件，开始发送KFC文案")
-                        
-                        # 导入消息组件
-                        from astrbot.api.message_components import Plain, Image
-                        
-                        # 发送逻辑
-                        for group_id in self.enabled_groups:
-                            try:
-                                # 获取KFC文案
-                                kfc_text = await self.get_llm_kfc_content(prompt_to_use, group_id)
-                                
-                                # 找到aiocqhttp平台
-                                platform = None
-                                for p in self.context.platform_manager.get_insts():
-                                    if p.meta().name == "aiocqhttp":
-                                        platform = p
-                                        break
-                                
-                                if platform:
-                                    # 直接通过平台API发送消息
-                                    client = platform.get_client()
-                                    
-                                    # 发送文本消息
-                                    await client.send_group_msg(
-                                        group_id=int(group_id), 
-                                        message=kfc_text
-                                    )
-                                    # 在发送图片前添加日志
-                                    logger.info(f"收款码图片路径: {self.payment_qrcode_path}")
-                                    logger.info(f"收款码图片是否存在: {os.path.exists(self.payment_qrcode_path)}")
-
-                                    # 发送图片
-                                    if os.path.exists(self.payment_qrcode_path):
-                                        try:
-                                            # 方法1: 使用CQ码的file协议，需要绝对路径
-                                            absolute_path = os.path.abspath(self.payment_qrcode_path)
-                                            await client.send_group_msg(
-                                                group_id=int(group_id),
-                                                message=f"[CQ:image,file=file:///{absolute_path}]"
-                                            )
-                                        except Exception as e1:
-                                            logger.error(f"方法1发送图片失败: {e1}")
-                                            try:
-                                                # 方法2: 使用base64编码发送
-                                                with open(self.payment_qrcode_path, 'rb') as f:
-                                                    import base64
-                                                    img_base64 = base64.b64encode(f.read()).decode()
-                                                    await client.send_group_msg(
-                                                        group_id=int(group_id),
-                                                        message=f"[CQ:image,file=base64://{img_base64}]"
-                                                    )
-                                            except Exception as e2:
-                                                logger.error(f"方法2发送图片失败: {e2}")
-
-                                    
-                                    logger.info(f"成功发送KFC文案到群 {group_id}")
-                                else:
-                                    logger.error("无法获取AIOCQHTTP平台")
-                                
-                                await asyncio.sleep(2)
-                            except Exception as e:
-                                logger.error(f"发送失败: {e}")
-                        
-                        # 发送完成，删除锁文件
-                        try:
-                            os.remove(lock_file_path)
-                            logger.info("文案发送完成，锁文件已删除")
-                        except:
-                            pass
-                        
-                        # 等待到下一分钟
-                        next_minute = now.replace(second=0) + datetime.timedelta(minutes=1)
-                        wait_seconds = (next_minute - datetime.datetime.now()).total_seconds() + 5
-                        await asyncio.sleep(max(30, wait_seconds))
-                    except Exception as e:
-                        logger.error(f"处理KFC发送时出错: {e}")
-                        # 确保锁文件被删除
-                        try:
-                            os.remove(lock_file_path)
-                        except:
-                            pass
-                else:
-                    # 不需要发送，等待
-                    await asyncio.sleep(10)
-                
-                # 午夜清理过期记录
-                if current_hour == 0 and current_minute == 0:
-                    processed_times = set(t for t in processed_times if today_str in t)
-                    with open(processed_file_path, "w") as f:
-                        for t in processed_times:
-                            f.write(f"{t}\n")
-                
-                # 继续等待检查
-                await asyncio.sleep(10)
+                    # 在账本中登记本时间点的所有群，每个群发送前单独认领，多个实例不会重复发送
+                    self._ledger.begin_slot(time_key, rule.prompt, fire_at.timestamp(), groups)
+                    
+                    # 本进程只发送分配给自己的群，其余的群由其他进程发送，失联进程的群稍后接管
+                    own_groups = self._coordinator.partition(groups)
+                    if own_groups:
+                        broadcasts.append(self._broadcast_slot(time_key, rule.prompt, own_groups))
+                    if len(own_groups) < len(groups):
+                        self._spawn_background(f"takeover:{time_key}", self._takeover_slot(time_key, rule.prompt))
+                await asyncio.gather(*broadcasts)
+                self._ledger.compact(self._view.ledger_ttl_days)
                     
             except Exception as e:
                 logger.error(f"定时任务出错: {e}")
-                await asyncio.sleep(60)
-                # 确保锁文件被删除
+                await self._clock.sleep(60)
+
+    async def _resume_unfinished_slots(self):
+        """补发崩溃或重启前未发送完的时间点，只发送尚未完成的群"""
+        since = self._clock.time() - RESUME_WINDOW
+        for attempt in range(2):
+            for slot_key, prompt in self._ledger.unfinished_slots(since):
+                self._release_dead_claims(slot_key)
+                groups = self._coordinator.partition(self._ledger.pending_groups(slot_key))
+                if groups:
+                    logger.info(f"时间点 {slot_key} 上次未发送完成，继续发送剩余的 {len(groups)} 个群")
+                    await self._broadcast_slot(slot_key, prompt, groups)
+            if attempt or not self._ledger.unfinished_slots(since):
+                return
+            # 其他进程认领但未完成的群，等认领过期后再接管一次
+            await self._clock.sleep(self._ledger.claim_ttl)
+
+    def _release_dead_claims(self, slot_key: str) -> int:
+        """释放心跳已过期的进程在时间点中认领的群，包括它正在发送和正在重试的群"""
+        live = set(self._coordinator.live_workers()) | {self._coordinator.worker_id}
+        released = self._ledger.release_claims(slot_key, live)
+        if released:
+            logger.info(f"时间点 {slot_key} 中已失联进程认领的 {released} 个群已释放")
+        return released
+
+    async def _takeover_slot(self, time_key: str, prompt: str):
+        """接管时间点中其他进程未发送的群，直到时间点完成或超过认领有效期
+
+        每隔一个心跳过期时间检查一次：释放已失联进程认领的群，再按当前存活的进程重新分配仍未发送的群，发送分给自己的部分
+        """
+        deadline = self._clock.time() + self._ledger.claim_ttl + self._coordinator.ttl
+        while True:
+            await self._clock.sleep(self._coordinator.ttl)
+            if self._ledger.is_slot_done(time_key):
+                return
+            self._release_dead_claims(time_key)
+            groups = self._coordinator.partition(self._ledger.pending_groups(time_key))
+            if groups:
+                logger.info(f"接管时间点 {time_key} 中其他进程未发送的 {len(groups)} 个群")
+                self._metrics.incr("takeover_groups", amount=len(groups))
+                await self._broadcast_slot(time_key, prompt, groups)
+            if self._clock.time() >= deadline:
+                return
+
+    def _get_rate_limiter(self, platform_key: str) -> "TokenBucket":
+        """获取指定平台的令牌桶限流器"""
+        limiter = self._rate_limiters.get(platform_key)
+        if limiter is None:
+            limiter = TokenBucket(
+                rate=self._view.send_rate_per_second,
+                capacity=self._view.send_rate_burst,
+                clock=self._clock,
+            )
+            self._rate_limiters[platform_key] = limiter
+        return limiter
+
+    async def _broadcast_slot(self, time_key: str, prompt: str, groups: list = None):
+        """以有限并发把一个时间点的文案发送到所有启用的群（或指定的群）"""
+        started = time.monotonic()
+        if groups is None:
+            groups = self.enabled_groups
+
+        # 按路由表把群分配到各个aiocqhttp平台实例
+        view = self._view
+        routes = self._platform_router.route_groups(
+            self.context.platform_manager.get_insts(), groups, view.shard_mode, view.group_routes,
+        )
+        if not routes:
+            logger.error("无法获取AIOCQHTTP平台")
+            self._metrics.incr("platform_missing")
+            return
+
+        self._qrcode.refresh()
+        if not self._dry_run:
+            await self._persona_resolver.prefetch(time_key, groups)
+        retry_deadline = self._clock.time() + view.retry_deadline_seconds
+        llm_timeout = view.llm_slot_timeout_seconds
+
+        async def send_queue(platform, platform_groups):
+            """单个平台实例的发送队列，各实例有独立的并发上限和限流器，彼此并行"""
+            platform_key = PlatformRouter.platform_key(platform)
+            limiter = self._get_rate_limiter(platform_key)
+            semaphore = asyncio.Semaphore(view.send_concurrency)
+
+            async def worker(group_id):
+                async with semaphore:
+                    # 认领失败说明该群已发送或正由其他实例发送
+                    if not self._ledger.claim(time_key, group_id):
+                        return None
+                    group_started = time.monotonic()
+                    ok = await self._send_to_group(platform, limiter, group_id, prompt, time_key, llm_timeout)
+                    self._metrics.observe("group_total", time.monotonic() - group_started, ok, group_id, platform_key, time_key)
+                    if ok:
+                        self._ledger.mark(time_key, group_id, "sent")
+                        self._metrics.record_result(group_id, platform_key, ok)
+                    else:
+                        # 失败的群在后台重试，不阻塞本时间点其他群的发送
+                        self._spawn_background(
+                            f"retry:{time_key}:{group_id}",
+                            self._retry_send(platform, limiter, group_id, prompt, time_key, retry_deadline),
+                        )
+                    return ok
+
+            return await asyncio.gather(*(worker(group_id) for group_id in platform_groups))
+
+        queue_results = await asyncio.gather(*(send_queue(platform, platform_groups) for platform, platform_groups in routes))
+        results = [ok for platform_results in queue_results for ok in platform_results]
+        succeeded = sum(1 for ok in results if ok)
+        attempted = sum(1 for ok in results if ok is not None)
+        self._ledger.finish_slot(time_key)
+        self._pregenerated.discard_slot(time_key)
+        duration = time.monotonic() - started
+        self._metrics.observe("slot_total", duration, succeeded == attempted, slot=time_key)
+        self._dump_metrics()
+        logger.info(f"时间点 {time_key} 发送完成: 成功 {succeeded}/{attempted} 个群，耗时 {duration:.2f} 秒")
+
+    async def _retry_send(self, platform, limiter: "TokenBucket", group_id, prompt: str, time_key: str, deadline: float):
+        """按带抖动的指数退避重试发送，超过重试次数或本时间点的截止时间后写入死信列表"""
+        platform_key = PlatformRouter.platform_key(platform)
+        max_attempts = self._view.retry_max_attempts
+        base_delay = self._view.retry_base_delay_seconds
+
+        attempt = 0
+        for attempt in range(1, max_attempts + 1):
+            # 等待时间不超过账本认领的有效期，避免其他实例在重试期间接管该群
+            delay = random.uniform(0, min(base_delay * 2 ** attempt, self._ledger.claim_ttl / 2))
+            if self._clock.time() + delay > deadline:
+                attempt -= 1
+                break
+            await self._clock.sleep(delay)
+            self._ledger.renew(time_key, group_id)
+            if await self._send_to_group(platform, limiter, group_id, prompt, time_key):
+                logger.info(f"第{attempt}次重试发送到群 {group_id} 成功")
+                self._ledger.mark(time_key, group_id, "sent")
+                self._ledger.finish_slot(time_key)
+                self._metrics.incr("retry_succeeded")
+                self._metrics.record_result(group_id, platform_key, True)
+                return
+
+        logger.error(f"群 {group_id} 在时间点 {time_key} 重试{attempt}次后仍发送失败，已写入死信列表")
+        self._ledger.mark(time_key, group_id, "failed")
+        self._ledger.finish_slot(time_key)
+        self._metrics.incr("dead_lettered")
+        self._metrics.record_result(group_id, platform_key, False)
+        self._dead_letters.add(time_key, group_id, prompt, platform_key, attempt)
+
+    async def replay_dead_letters(self, limit: int = None) -> tuple:
+        """重新发送死信列表中的群，返回(重放数量, 成功数量)；再次失败的会重新进入重试和死信流程
+
+        记录只在发送成功或已交给重试任务后才从死信列表移除，没有可用平台或进程中途退出时记录仍会保留
+        """
+        entries = self._dead_letters.peek(limit)
+        by_slot = {}
+        for entry in entries:
+            by_slot.setdefault((entry["slot"], entry["prompt"]), []).append(entry)
+
+        replayed = succeeded = 0
+        for (slot_key, prompt), slot_entries in by_slot.items():
+            groups = [entry["group_id"] for entry in slot_entries]
+            self._ledger.begin_slot(slot_key, prompt, self._clock.time(), groups)
+            for group_id in groups:
+                self._ledger.reopen(slot_key, group_id)
+            await self._broadcast_slot(slot_key, prompt, groups)
+
+            # 已发送的群和正在重试的群移出死信列表，仍待发送的群说明本次没有发出去，恢复为失败
+            statuses = self._ledger.statuses(slot_key, groups)
+            handled = [entry for entry in slot_entries if statuses.get(entry["group_id"]) in ("sent", "claimed")]
+            self._ledger.restore_failed(slot_key, [g for g in groups if statuses.get(g) == "pending"])
+            self._ledger.finish_slot(slot_key)
+            self._dead_letters.remove(handled)
+            replayed += len(handled)
+            succeeded += sum(1 for entry in handled if statuses.get(entry["group_id"]) == "sent")
+        return replayed, succeeded
+
+    async def simulate(self, days: int = 30, start: datetime.datetime = None) -> dict:
+        """用虚拟时钟按当前配置模拟运行若干天：使用内存账本，只记录发送，不调用LLM和平台接口"""
+        clock = SimulatedClock(start or self._clock.now())
+        begin = clock.now()
+        end = begin + datetime.timedelta(days=days)
+        started = time.monotonic()
+        # 模拟使用配置的副本，不会改写正在使用的配置；配置文件检查间隔照常计入唤醒次数，但不会读取配置文件
+        simulator = KFCThursdayPlugin(self.context, dict(self.config), clock=clock, dry_run=True)
+        simulator._config_mtime = self._config_mtime
+        try:
+            await clock.run_until(end)
+        finally:
+            await simulator.terminate()
+
+        sends = simulator._dry_run_sends
+        counters = simulator._metrics.counters
+        return {
+            "start": begin,
+            "end": end,
+            "slots": sorted({slot_key for _, slot_key, _, _ in sends}),
+            "sends": len(sends),
+            "groups": len({group_id for _, _, group_id, _ in sends}),
+            "wakeups": counters.get(("scheduler_wakeup",), 0),
+            "prewarms": counters.get(("prewarm",), 0),
+            "elapsed": time.monotonic() - started,
+        }
+
+    def _dump_metrics(self):
+        """配置了指标文件路径时导出Prometheus文本"""
+        dump_path = self._view.metrics_dump_path
+        if dump_path and not self._dry_run:
+            self._metrics.dump(dump_path)
+
+    async def _send_to_group(self, platform, limiter: "TokenBucket", group_id, prompt: str, slot_key: str, llm_timeout: float = None) -> bool:
+        """生成文案并发送到单个群，返回是否发送成功；llm_timeout为文案生成任务的超时秒数"""
+        if self._dry_run:
+            self._dry_run_sends.append((self._clock.now(), slot_key, str(group_id), PlatformRouter.platform_key(platform)))
+            return True
+        try:
+            # 直接通过平台API发送消息
+            client = platform.get_client()
+            platform_key = PlatformRouter.platform_key(platform)
+            labels = {"group_id": group_id, "platform": platform_key, "slot": slot_key}
+
+            # 获取KFC文案
+            with self._metrics.measure("generate", **labels):
+                kfc_text = await self.get_llm_kfc_content(prompt, group_id, slot_key, llm_timeout)
+
+            # 文案和收款码合并为一条消息发送
+            if self._qrcode.exists:
+                transport, file = self._qrcode.sources(platform_key)[0]
                 try:
-                    if os.path.exists(lock_file_path):
-                        os.remove(lock_file_path)
-                except:
-                    pass
+                    await limiter.acquire()
+                    with self._metrics.measure("send_combined", **labels):
+                        result = await client.send_group_msg(
+                            group_id=int(group_id),
+                            message=self._to_onebot_message(self._build_kfc_chain(kfc_text, file))
+                        )
+                    if self._qrcode.mark_succeeded(platform_key, transport):
+                        await self._remember_uploaded_qrcode(platform_key, client, result)
+                    logger.info(f"成功发送KFC文案到群 {group_id}")
+                    return True
+                except Exception as e:
+                    logger.warning(f"合并发送到群 {group_id} 失败，改为分开发送: {e}")
+                    self._metrics.incr("combined_send_fallback")
+                    self._qrcode.mark_failed(platform_key, transport)
+
+            # 发送文本消息
+            await limiter.acquire()
+            with self._metrics.measure("send_text", **labels):
+                await client.send_group_msg(
+                    group_id=int(group_id), 
+                    message=kfc_text
+                )
+            # 发送图片
+            if self._qrcode.exists:
+                with self._metrics.measure("send_image", **labels):
+                    await self._send_qrcode(platform_key, client, group_id, limiter)
 
+            logger.info(f"成功发送KFC文案到群 {group_id}")
+            return True
+        except Exception as e:
+            logger.error(f"发送到群 {group_id} 失败: {e}")
+            return False
 
-    async def get_llm_kfc_content(self, prompt_template: str, group_id: str) -> str:
-        """调用LLM生成KFC文案"""
+    @staticmethod
+    def _build_kfc_chain(text: str, image_file: str = None) -> list:
+        """构建文案和收款码组成的消息链，定时发送和指令共用"""
+        from astrbot.api.message_components import Plain, Image
+        chain = [Plain(text=text)]
+        if image_file:
+            chain.append(Image(file=image_file))
+        return chain
+
+    @staticmethod
+    def _to_onebot_message(chain: list) -> list:
+        """把消息链转换为OneBot消息段数组"""
+        return [component.toDict() for component in chain]
+
+    async def _send_qrcode(self, platform_key: str, client, group_id, limiter: "TokenBucket") -> bool:
+        """按该平台上次成功的方式发送收款码，失败时依次尝试其他方式"""
+        for transport, file in self._qrcode.sources(platform_key):
+            try:
+                await limiter.acquire()
+                result = await client.send_group_msg(
+                    group_id=int(group_id),
+                    message=f"[CQ:image,file={file}]"
+                )
+            except Exception as e:
+                logger.error(f"使用{transport}方式发送图片失败: {e}")
+                self._qrcode.mark_failed(platform_key, transport)
+                self._metrics.incr(f"image_{transport}_failed")
+                continue
+
+            if self._qrcode.mark_succeeded(platform_key, transport):
+                await self._remember_uploaded_qrcode(platform_key, client, result)
+            return True
+        return False
+
+    async def _remember_uploaded_qrcode(self, platform_key: str, client, result):
+        """首次发送成功后查询已发送的消息，记下平台返回的图片文件ID供后续复用"""
+        message_id = result.get("message_id") if isinstance(result, dict) else None
+        if not message_id:
+            return
         try:
-            # 构建一个虚拟的消息会话标识符
-            unified_msg_origin = f"aiocqhttp:GROUP_MESSAGE:{group_id}"
-            
-            # 尝试获取当前会话ID
-            curr_cid = await self.context.conversation_manager.get_curr_conversation_id(unified_msg_origin)
-            
-            # 如果没有会话ID，创建一个新的
-            if not curr_cid:
-                curr_cid = await self.context.conversation_manager.new_conversation(unified_msg_origin)
-                
-            # 获取会话
-            conversation = await self.context.conversation_manager.get_conversation(unified_msg_origin, curr_cid)
-            contexts = json.loads(conversation.history) if hasattr(conversation, 'history') and conversation.history else []
+            message = await client.get_msg(message_id=message_id)
+        except Exception as e:
+            logger.debug(f"平台 {platform_key} 不支持查询已发送图片: {e}")
+            return
+        for segment in (message or {}).get("message", []):
+            if isinstance(segment, dict) and segment.get("type") == "image":
+                file_id = segment.get("data", {}).get("file")
+                if file_id and not file_id.startswith(("file://", "base64://")):
+                    self._qrcode.remember_file_id(platform_key, file_id)
+                    logger.info(f"平台 {platform_key} 已缓存收款码图片文件ID")
+                return
+
+    def _build_contexts(self, conversation) -> list:
+        """按上下文模式从会话历史中构建LLM上下文，并限制在token预算内"""
+        view = self._view
+        if view.context_mode == "none" or not getattr(conversation, "history", None):
+            return []
+        max_messages = None
+        if view.context_mode == "last_k":
+            max_messages = view.context_last_k
+            if max_messages <= 0:
+                return []
+        return self._context_builder.build(
+            conversation.history,
+            token_budget=view.context_token_budget,
+            max_messages=max_messages,
+            cache_key=getattr(conversation, "cid", None) or id(conversation),
+        )
+
+    def _is_per_group_generation(self) -> bool:
+        """是否需要为每个群单独生成文案（使用群聊上下文或开启了逐群差异化）"""
+        return self._view.per_group_generation
+
+    async def _generate_with_retry(self, generate):
+        """调用生成函数，失败后按llm_retry_count重试"""
+        retries = self._view.llm_retry_count
+        for attempt in range(retries + 1):
+            try:
+                return await generate()
+            except Exception as e:
+                if attempt >= retries:
+                    raise
+                logger.warning(f"LLM调用失败，第{attempt + 1}次重试: {e}")
+
+    async def _call_provider(self, provider, prompt: str, system_prompt: str, contexts: list) -> str:
+        """调用LLM，单次调用超过llm_call_timeout_seconds视为失败
+
+        provider支持流式输出时按块读取，超过llm_stream_idle_seconds没有新内容就提前判定为超时
+        """
+        call_timeout = self._view.llm_call_timeout_seconds
+        idle_timeout = self._view.llm_stream_idle_seconds
+        text_chat_stream = getattr(provider, "text_chat_stream", None)
+        if text_chat_stream is None or not self._view.llm_streaming:
+            try:
+                llm_response = await asyncio.wait_for(
+                    provider.text_chat(prompt=prompt, system_prompt=system_prompt, contexts=contexts),
+                    timeout=call_timeout,
+                )
+            except asyncio.TimeoutError:
+                raise asyncio.TimeoutError(f"LLM调用超过 {call_timeout:g} 秒未返回")
+            return llm_response.completion_text
+
+        async def read_stream():
+            chunks = text_chat_stream(prompt=prompt, system_prompt=system_prompt, contexts=contexts).__aiter__()
+            parts = []
+            while True:
+                try:
+                    llm_response = await asyncio.wait_for(chunks.__anext__(), timeout=idle_timeout)
+                except StopAsyncIteration:
+                    return "".join(parts)
+                except asyncio.TimeoutError:
+                    raise asyncio.TimeoutError(f"LLM流式输出超过 {idle_timeout:g} 秒没有新内容")
+                # 流式输出的最后一个响应不是增量，包含完整文本
+                if not getattr(llm_response, "is_chunk", False):
+                    return llm_response.completion_text or "".join(parts)
+                parts.append(llm_response.completion_text or "")
+
+        try:
+            return await asyncio.wait_for(read_stream(), timeout=call_timeout)
+        except asyncio.TimeoutError as e:
+            raise asyncio.TimeoutError(str(e) or f"LLM调用超过 {call_timeout:g} 秒未返回")
+
+    def _get_command_limiters(self) -> tuple:
+        """/kfc 按群和按用户的限流器: (群限流器, 用户限流器)"""
+        if self._command_limiters is None:
+            self._command_limiters = (
+                KeyedRateLimiter(self._view.kfc_group_per_minute, self._clock),
+                KeyedRateLimiter(self._view.kfc_user_per_minute, self._clock),
+            )
+        return self._command_limiters
+
+    def _get_copy_pool_budget(self) -> TokenBucket:
+        """文案池补充的LLM调用预算，每小时最多copy_pool_llm_calls_per_hour次"""
+        if self._copy_pool_budget is None:
+            calls_per_hour = self._view.copy_pool_llm_calls_per_hour
+            self._copy_pool_budget = TokenBucket(calls_per_hour / 3600, calls_per_hour, self._clock)
+        return self._copy_pool_budget
+
+    async def _generate_pool_copy(self, provider, personality_prompt: str) -> str:
+        """在预算内为文案池生成一条文案，预算用完时返回None"""
+        if not self._get_copy_pool_budget().try_acquire():
+            self._metrics.incr("copy_pool_budget_exhausted")
+            return None
+        prompt = random.choice(list(self._view.time_prompts.values()))
+        with self._metrics.measure("llm", slot="copy_pool"):
+            return await self._call_provider(provider, prompt, personality_prompt, [])
+
+    async def _refill_copy_pool(self, provider, personality_prompt: str):
+        """把人格对应的文案池补充到copy_pool_size条，近似重复的文案不入池；尝试次数有上限，避免重复文案反复消耗调用"""
+        target = self._view.copy_pool_size
+        attempts = 2 * (target - self._copy_pool.size(personality_prompt))
+        while attempts > 0 and self._copy_pool.size(personality_prompt) < target:
+            attempts -= 1
+            try:
+                text = await self._generate_pool_copy(provider, personality_prompt)
+            except Exception as e:
+                logger.warning(f"补充KFC文案池失败: {e}")
+                return
+            if text is None:
+                return
+            if not self._copy_pool.add(personality_prompt, text):
+                self._metrics.incr("copy_pool_duplicate")
+
+    def _maybe_refill_copy_pool(self, provider, personality_prompt: str):
+        """文案池低于copy_pool_low_water条时在后台补充，同一人格只运行一个补充任务"""
+        if self._copy_pool.size(personality_prompt) >= self._view.copy_pool_low_water:
+            return
+        name = f"copy_pool:{hashlib.sha1(personality_prompt.encode('utf-8')).hexdigest()[:12]}"
+        self._spawn_background(name, self._refill_copy_pool(provider, personality_prompt))
+
+    async def get_pooled_kfc_content(self, group_id) -> str:
+        """从人格对应的文案池取一条文案，池为空时在预算内现场生成一条，预算用完时使用默认文案"""
+        try:
+            # 命令每次都解析群的当前会话，/new 或 /switch 之后立即使用新会话的人格
+            conversation = await self._persona_resolver.resolve(group_id)
+            provider = self.context.get_using_provider()
+            if not provider:
+                self._metrics.incr("provider_missing")
+                return "KFC疯狂星期四，炸鸡疯狂8.8折，快来KFC享用美味吧！"
+            personality_prompt = self._persona_resolver.personality_prompt(conversation, provider)
+
+            text = self._copy_pool.take(personality_prompt)
+            if text is not None:
+                self._metrics.incr("copy_pool_hit")
+            else:
+                # 池为空时现场生成，与最近发出的文案近似重复时在预算内重新生成一次
+                self._metrics.incr("copy_pool_miss")
+                for _ in range(2):
+                    text = await self._generate_pool_copy(provider, personality_prompt)
+                    if text is None or not self._copy_pool.is_duplicate(personality_prompt, shingle_hashes(text)):
+                        break
+                    self._metrics.incr("copy_pool_duplicate")
+                if text:
+                    self._copy_pool.mark_served(personality_prompt, text)
+            self._maybe_refill_copy_pool(provider, personality_prompt)
+            return text or "KFC疯狂星期四，V我50，请速速行动！🍗"
+        except Exception as e:
+            logger.error(f"LLM调用失败: {e}")
+            self._metrics.incr("llm_fallback")
+            return "KFC疯狂星期四，V我50，请速速行动！🍗"
+
+    async def get_llm_kfc_content(self, prompt_template: str, group_id: str, slot_key: str = None, timeout: float = None) -> str:
+        """调用LLM生成KFC文案
+
+        传入slot_key时，同一时间点、相同提示词和人格的群共用一次生成结果；
+        传入timeout时，生成任务开始后超过timeout秒仍未完成的群改用该键上一次生成的文案或默认文案
+        """
+        try:
+            # 获取群的当前会话，定时发送时直接使用时间点开始时批量解析的结果
+            conversation = await self._persona_resolver.get_conversation(group_id, slot_key)
             
             # 获取当前提供商
             provider = self.context.get_using_provider()
             if not provider:
+                self._metrics.incr("provider_missing")
                 return "KFC疯狂星期四，炸鸡疯狂8.8折，快来KFC享用美味吧！"
             
             # 动态获取人格提示词
-            personality_prompt = ""
-            
-            # 从会话中获取人格ID
-            if conversation and hasattr(conversation, 'persona_id'):
-                persona_id = conversation.persona_id
-                
-                # 获取所有已加载的人格
-                all_personas = self.context.provider_manager.personas
-                
-                # 如果用户明确取消了人格
-                if persona_id == "[%None]":
-                    personality_prompt = ""  # 用户明确取消了人格，使用空提示
-                # 如果用户设置了特定人格
-                elif persona_id:
-                    # 在所有人格中查找匹配的人格
-                    for persona in all_personas:
-                        if persona.get("name") == persona_id:
-                            personality_prompt = persona.get("prompt", "")
-                            break
-                # 如果没有设置人格（新会话），使用默认人格
-                else:
-                    # 获取默认人格名称
-                    default_persona = self.context.provider_manager.selected_default_persona
-                    if default_persona:
-                        default_persona_name = default_persona.get("name")
-                        # 在所有人格中查找默认人格
-                        for persona in all_personas:
-                            if persona.get("name") == default_persona_name:
-                                personality_prompt = persona.get("prompt", "")
-                                break
+            personality_prompt = self._persona_resolver.personality_prompt(conversation, provider)
             
-            # 如果上面的逻辑没有找到人格提示词，使用提供商的当前人格作为备选
-            if not personality_prompt and hasattr(provider, 'curr_personality') and provider.curr_personality:
-                personality_prompt = provider.curr_personality.get("prompt", "")
-            
-            # 调用LLM
-            llm_response = await provider.text_chat(
-                prompt=prompt_template,
-                system_prompt=personality_prompt,
-                contexts=contexts,
-            )
-            
-            return llm_response.completion_text
+            async def generate():
+                # 调用LLM
+                with self._metrics.measure("llm", group_id=group_id, slot=slot_key):
+                    return await self._call_provider(provider, prompt_template, personality_prompt, self._build_contexts(conversation))
+
+            if slot_key is None:
+                return await generate()
+
+            # 同一时间点内复用生成结果，优先使用磁盘队列中预生成的文案
+            per_group = self._is_per_group_generation()
+            cache_key = (slot_key, prompt_template, personality_prompt, str(group_id) if per_group else None)
+
+            # 逐群生成时上一次的文案也按群区分，超时不会用到其他群的文案
+            last_key = cache_key[1:]
+
+            text = self._pregenerated.get(cache_key)
+            if text is not None:
+                self._last_completions[last_key] = text
+                return text
+
+            async def generate_for_slot():
+                text = await self._generate_with_retry(generate)
+                self._pregenerated.put(cache_key, slot_key, text)
+                self._last_completions[last_key] = text
+                return text
+
+            try:
+                return await self._generation_cache.get_or_create(cache_key, generate_for_slot, timeout)
+            except asyncio.TimeoutError:
+                cached = self._last_completions.get(last_key)
+                logger.warning(f"群 {group_id} 的文案生成超时，改用{'上一次生成的文案' if cached else '默认文案'}")
+                self._metrics.incr("llm_timeout_cached" if cached else "llm_timeout_fallback")
+                return cached or "KFC疯狂星期四，V我50，请速速行动！🍗"
             
         except Exception as e:
             logger.error(f"LLM调用失败: {e}")
+            self._metrics.incr("llm_fallback")
             return "KFC疯狂星期四，V我50，请速速行动！🍗"
 
     
     @filter.command("kfc")
     async def kfc_command(self, event: AstrMessageEvent):
         """测试命令，立即生成一条KFC文案"""
+        self._check_config_file()
+        
         # 检查是否是星期四
-        now = datetime.datetime.now()
+        now = self._clock.now()
         if now.weekday() != 3:  # 星期四的索引是3
             yield event.plain_result(f"今天是星期{now.weekday() + 1}，不是星期四，KFC星期四活动尚未开始。")
             return
             
         # 检查是否在启用的群列表中
         group_id = event.get_group_id()
-        if not group_id or str(group_id) not in [str(g) for g in self.enabled_groups]:
+        if not group_id or str(group_id) not in self._view.enabled_group_set:
             yield event.plain_result("此群未启用KFC星期四活动。")
             return
             
-        # 随机选择一个提示词
-        prompt = random.choice(list(self.time_prompts.values()))
-        
-        # 获取LLM生成的文案
-        kfc_text = await self.get_llm_kfc_content(prompt, group_id)
+        # 按用户和按群限流
+        group_limiter, user_limiter = self._get_command_limiters()
+        user_id = str(event.get_sender_id())
+        if not user_limiter.check(user_id) or not group_limiter.check(str(group_id)):
+            self._metrics.incr("kfc_rate_limited")
+            yield event.plain_result("请求太频繁了，稍后再来吧~")
+            return
+        # 两个限流都通过后才消耗令牌，被群限流拒绝时不占用用户的次数
+        user_limiter.allow(user_id)
+        group_limiter.allow(str(group_id))
         
-        # 创建包含图片和文本的消息链
-        from astrbot.api.message_components import Plain, Image
-        chain = [Plain(text=kfc_text)]
+        # 从文案池获取文案，池中文案不足时在后台补充
+        kfc_text = await self.get_pooled_kfc_content(group_id)
         
-        # 如果存在收款码图片，则添加到消息链中
-        if os.path.exists(self.payment_qrcode_path):
-            chain.append(Image.fromFileSystem(self.payment_qrcode_path))
+        # 创建包含图片和文本的消息链，如果存在收款码图片则一并加入
+        image_file = f"base64://{self._qrcode.base64}" if self._qrcode.refresh() else None
+        chain = self._build_kfc_chain(kfc_text, image_file)
         
         # 一次性发送整个消息链
         yield event.chain_result(chain)
@@ -422,8 +2350,10 @@ class KFCThursdayPlugin(Star):
             hour: 小时(0-23)，默认为当前小时
             minute: 分钟(0-59)，默认为当前分钟
         """
+        self._check_config_file()
+        
         # 获取当前时间，或使用用户提供的时间
-        now = datetime.datetime.now()
+        now = self._clock.now()
         
         if weekday is not None:
             # 确保weekday在1-7范围内
@@ -446,27 +2376,79 @@ class KFCThursdayPlugin(Star):
             return
         
         # 使用自定义时间和星期
-        custom_prompt = self.config.get("custom_prompt", "今天是KFC疯狂星期X，请你写一段有创意的肯德基推销文案，让人们想要购买肯德基。")
+        custom_prompt = self._view.custom_prompt
         custom_prompt = custom_prompt.replace("X", str(weekday + 1))  # 替换X为实际星期几
         
         # 获取LLM生成的文案
         kfc_text = await self.get_llm_kfc_content(custom_prompt, group_id)
         
-        # 创建包含图片和文本的消息链
-        from astrbot.api.message_components import Plain, Image
-        chain = [Plain(text=f"星期{weekday + 1} {time_str}\n{kfc_text}")]
-        
-        # 如果存在收款码图片，则添加到消息链中
-        if os.path.exists(self.payment_qrcode_path):
-            chain.append(Image.fromFileSystem(self.payment_qrcode_path))
+        # 创建包含图片和文本的消息链，如果存在收款码图片则一并加入
+        image_file = f"base64://{self._qrcode.base64}" if self._qrcode.refresh() else None
+        chain = self._build_kfc_chain(f"星期{weekday + 1} {time_str}\n{kfc_text}", image_file)
         
         # 一次性发送整个消息链
         yield event.chain_result(chain)
         
+    @filter.command("kfc_simulate")
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    async def kfc_simulate(self, event: AstrMessageEvent, days: int = 30):
+        """按当前配置快速模拟运行若干天，不会真正发送
+        参数:
+            days: 模拟的天数，默认30天
+        """
+        days = max(1, min(366, days))
+        result = await self.simulate(days)
+        slots = result["slots"]
+        lines = [
+            f"模拟 {result['start'].strftime('%Y-%m-%d %H:%M')} ~ {result['end'].strftime('%Y-%m-%d %H:%M')}（{days}天），耗时 {result['elapsed']:.2f} 秒",
+            f"触发时间点: {len(slots)} 个，发送: {result['sends']} 次（{result['groups']} 个群）",
+            f"调度器唤醒: {result['wakeups']} 次，预生成: {result['prewarms']} 次",
+        ]
+        if slots:
+            lines.append("前几个时间点:")
+            lines.extend(f"- {slot_key}" for slot_key in slots[:5])
+        yield event.plain_result("\n".join(lines))
+
+    @filter.command("kfc_replay")
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    async def kfc_replay(self, event: AstrMessageEvent, action: str = "list", limit: int = None):
+        """查看或重放发送失败的群
+        参数:
+            action: list 查看死信列表（默认），run 重新发送
+            limit: 重新发送的最大条数，默认全部
+        """
+        if action != "run":
+            entries = self._dead_letters.entries()
+            if not entries:
+                yield event.plain_result("死信列表为空")
+                return
+            lines = [f"死信列表共 {len(entries)} 条（最近10条）:"]
+            for entry in entries[-10:]:
+                failed_at = datetime.datetime.fromtimestamp(entry["failed_at"]).strftime("%m-%d %H:%M")
+                lines.append(f"- {entry['slot']} 群{entry['group_id']} 平台{entry['platform']} 重试{entry['attempts']}次 {failed_at}")
+            lines.append("使用 /kfc_replay run [条数] 重新发送")
+            yield event.plain_result("\n".join(lines))
+            return
+
+        requested = len(self._dead_letters.peek(limit))
+        replayed, succeeded = await self.replay_dead_letters(limit)
+        result = f"已重放 {replayed} 条，首次发送成功 {succeeded} 条，其余已进入重试队列"
+        if replayed < requested:
+            result += f"；{requested - replayed} 条未能发出，仍保留在死信列表中"
+        yield event.plain_result(result)
+
+    @filter.command("kfc_metrics")
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    async def kfc_metrics(self, event: AstrMessageEvent):
+        """查看KFC发送链路的耗时与成功率指标"""
+        self._dump_metrics()
+        yield event.plain_result(self._metrics.summary())
+
     @filter.command("kfc_status")
     async def kfc_status(self, event: AstrMessageEvent):
         """查看KFC插件状态"""
-        now = datetime.datetime.now()
+        self._check_config_file()
+        now = self._clock.now()
         is_thursday = now.weekday() == 3
         
         if not is_thursday:
@@ -481,27 +2463,42 @@ class KFCThursdayPlugin(Star):
         if not is_thursday:
             status_text += f"距离下一个星期四: {days_until_thursday}天 ({next_thursday_str})\n"
         
-        status_text += f"已启用群组数: {len(self.enabled_groups)}\n"
-        status_text += f"群组列表: {', '.join(self.enabled_groups) if self.enabled_groups else '无'}\n"
+        view = self._view
+        status_text += f"已启用群组数: {len(view.enabled_groups)}\n"
+        status_text += f"群组列表: {', '.join(view.enabled_groups) if view.enabled_groups else '无'}\n"
         
         # 显示时间点及其状态
         status_text += "发送时间点状态:\n"
-        status_text += f"- 10:00: {'启用' if self.config.get('morning_enabled', True) else '禁用'}\n"
-        status_text += f"- 12:00: {'启用' if self.config.get('noon_enabled', True) else '禁用'}\n"
-        status_text += f"- 18:00: {'启用' if self.config.get('evening_enabled', True) else '禁用'}\n"
-        status_text += f"- 20:00: {'启用' if self.config.get('night_enabled', True) else '禁用'}\n"
+        for time_str, enabled in view.presets:
+            status_text += f"- {time_str}: {'启用' if enabled else '禁用'}\n"
         
         # 显示自定义时间点
-        custom_times = self.config.get("custom_times", {})
-        if custom_times:
-            weekday = custom_times.get("weekday", 4)
-            hour = custom_times.get("hour", 18)
-            minute = custom_times.get("minute", 30)
-            custom_enabled = custom_times.get("enabled", True)
+        if view.custom_time:
+            custom_enabled, weekday, hour, minute = view.custom_time
             status_text += f"自定义时间点:\n"
             status_text += f"- 状态: {'启用' if custom_enabled else '禁用'}\n"
             status_text += f"- 时间: 星期{weekday} {hour:02d}:{minute:02d}\n"
         
-        status_text += f"收款码图片: {'存在' if os.path.exists(self.payment_qrcode_path) else '不存在'}"
+        # 显示接下来的发送时间点
+        index = view.index
+        custom_rule_count = sum(1 for rule in index.rules if rule.key.startswith("rule"))
+        status_text += f"发送规则: {len(index.rules)}条（其中schedule_rules {custom_rule_count} 条）\n"
+        upcoming = index.upcoming(now, view.status_upcoming_count)
+        if upcoming:
+            status_text += "即将发送:\n"
+            for fire_at, rules in upcoming:
+                targets = ", ".join(f"{rule.key}({len(groups)}个群)" for rule, groups in self._assign_groups(rules))
+                status_text += f"- {fire_at.strftime('%Y-%m-%d %H:%M')} 星期{fire_at.weekday() + 1}: {targets}\n"
+        
+        status_text += f"收款码图片: {'存在' if self._qrcode.refresh() else '不存在'}\n"
+        
+        # 多进程协调状态
+        workers = self._coordinator.live_workers()
+        status_text += f"工作进程: {len(workers)}个存活，本进程负责 {len(self._coordinator.partition(view.enabled_groups))}/{len(view.enabled_groups)} 个群\n"
+        
+        # 后台任务健康状态
+        health = self.health()
+        scheduler_ok = health.get("scheduler") == "运行中"
+        status_text += f"定时任务: {'正常' if scheduler_ok else '未运行'}（共 {len(health)} 个后台任务: {', '.join(f'{name} {state}' for name, state in health.items())}）"
         
         yield event.plain_result(status_text)
@@ -0,0 +1,37 @@
+import argparse
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+
+benchmark.install_astrbot_stubs()
+
+
+@pytest.fixture
+def plugin_module(tmp_path):
+    """复制到临时目录导入的插件模块，账本、预生成文案和死信列表都写在临时目录"""
+    return benchmark.load_plugin_module(str(tmp_path))
+
+
+@pytest.fixture
+def make_context():
+    """构造benchmark中的假AstrBot上下文，参数与benchmark的命令行参数一致"""
+    def factory(**overrides):
+        args = argparse.Namespace(
+            llm_latency=0.0,
+            llm_failure_rate=0.0,
+            send_latency=0.0,
+            send_failure_rate=0.0,
+            history_messages=4,
+            instances=1,
+        )
+        for key, value in overrides.items():
+            setattr(args, key, value)
+        return benchmark.FakeContext(args, random.Random(0))
+
+    return factory
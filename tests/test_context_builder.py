@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+
+def make_history(count: int) -> list:
+    messages = []
+    for i in range(count):
+        messages.append({"role": "user", "content": f"第{i}条用户消息，今天是疯狂星期四"})
+        messages.append({"role": "assistant", "content": f"第{i}条回复 V我50"})
+    return messages
+
+
+def reference(plugin_module, messages: list, token_budget: int, max_messages: int = None) -> list:
+    """完整解析后裁剪的结果"""
+    builder = plugin_module.ContextBuilder()
+    contexts, _ = builder._trim(messages, token_budget, max_messages)
+    return contexts
+
+
+@pytest.mark.parametrize("dump_options", [
+    {"ensure_ascii": True},
+    {"ensure_ascii": False},
+    {"ensure_ascii": False, "indent": 2},
+    {"ensure_ascii": True, "indent": 4, "sort_keys": True},
+])
+def test_tail_parse_matches_full_parse(plugin_module, dump_options):
+    messages = make_history(500)
+    history = json.dumps(messages, **dump_options)
+    builder = plugin_module.ContextBuilder()
+
+    contexts = builder.build(history, token_budget=200)
+    assert contexts == reference(plugin_module, messages, 200)
+    assert contexts and contexts[0]["role"] == "user"
+    # 只解析了尾部：最早的消息不在结果中
+    assert contexts[-1] == messages[-1]
+
+    assert builder.build(history, max_messages=5) == reference(plugin_module, messages, 0, 5)
+
+    # 从任意位置开始都能找到下一条完整消息，而不是退回完整解析
+    for start in range(len(history) // 2, len(history) // 2 + 400, 7):
+        tail = builder._parse_tail(history, start)
+        assert tail is not None
+        assert tail == messages[len(messages) - len(tail):]
+
+
+def test_tool_and_list_content_are_parsed_and_counted(plugin_module):
+    messages = make_history(300) + [
+        {"role": "user", "content": [{"type": "text", "text": "帮我查一下{KFC}的菜单"}, {"type": "image_url", "image_url": {"url": "x"}}]},
+        {"role": "assistant", "content": None, "tool_calls": [{"id": "call_1", "function": {"name": "menu", "arguments": "{\"day\": 4}"}}]},
+        {"role": "tool", "tool_call_id": "call_1", "content": "{\"items\": [\"疯狂星期四套餐\"]}"},
+        {"role": "assistant", "content": "今天的套餐是疯狂星期四套餐"},
+    ]
+    for options in ({"ensure_ascii": True}, {"ensure_ascii": False, "indent": 2}):
+        history = json.dumps(messages, **options)
+        contexts = plugin_module.ContextBuilder().build(history, token_budget=100)
+        assert contexts == reference(plugin_module, messages, 100)
+        assert [message["role"] for message in contexts[-4:]] == ["user", "assistant", "tool", "assistant"]
+
+    builder = plugin_module.ContextBuilder()
+    assert builder._message_tokens(messages[-4]) == plugin_module.estimate_tokens("帮我查一下{KFC}的菜单") + 4
+
+
+def test_budget_that_only_fits_trailing_assistant_gives_empty_context(plugin_module):
+    messages = [
+        {"role": "user", "content": "很长的用户消息" * 50},
+        {"role": "assistant", "content": "短回复"},
+    ]
+    history = json.dumps(messages, ensure_ascii=False)
+    assert plugin_module.ContextBuilder().build(history, token_budget=20) == []
+
+
+def test_window_grows_until_budget_is_filled(plugin_module):
+    # 每条消息的JSON很长但token很少，初始窗口内的消息填不满预算，需要扩大窗口
+    messages = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": "ok", "metadata": {"padding": "-" * 400, "index": i}}
+        for i in range(2000)
+    ]
+    history = json.dumps(messages)
+    builder = plugin_module.ContextBuilder()
+    parsed_starts = []
+    parse_tail = builder._parse_tail
+
+    def recording_parse_tail(text, start):
+        parsed_starts.append(start)
+        return parse_tail(text, start)
+
+    builder._parse_tail = recording_parse_tail
+    contexts = builder.build(history, token_budget=1000)
+    assert contexts == reference(plugin_module, messages, 1000)
+    assert len(contexts) > 100
+    assert len(parsed_starts) > 1
+    assert parsed_starts == sorted(parsed_starts, reverse=True)
+
+
+def test_results_are_cached_until_history_changes(plugin_module):
+    messages = make_history(50)
+    builder = plugin_module.ContextBuilder()
+    history = json.dumps(messages, ensure_ascii=False)
+    first = builder.build(history, token_budget=100, cache_key="cid")
+    assert builder.build(history, token_budget=100, cache_key="cid") is first
+
+    messages.append({"role": "user", "content": "新消息"})
+    changed = builder.build(json.dumps(messages, ensure_ascii=False), token_budget=100, cache_key="cid")
+    assert changed is not first
+    assert changed[-1]["content"] == "新消息"
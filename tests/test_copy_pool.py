@@ -0,0 +1,34 @@
+def test_near_duplicates_are_rejected(plugin_module):
+    pool = plugin_module.CopyPool(similarity=0.6)
+    assert pool.add("default", "今天是肯德基疯狂星期四，谁请我吃？")
+    # 只差标点和空白的文案视为重复
+    assert not pool.add("default", "今天是肯德基疯狂星期四 谁请我吃!!")
+    assert pool.add("default", "我不是人，我是疯狂星期四的鸡翅，V我50复活")
+    # 不同人格的池互不影响
+    assert pool.add("other", "今天是肯德基疯狂星期四，谁请我吃？")
+    assert pool.size("default") == 2
+    assert pool.size("other") == 1
+
+
+def test_take_is_fifo_and_remembers_served_copies(plugin_module):
+    pool = plugin_module.CopyPool(similarity=0.6, history_size=1)
+    pool.add("default", "第一条文案：疯狂星期四")
+    pool.add("default", "第二条文案：V我50吃原味鸡")
+    assert pool.take("default") == "第一条文案：疯狂星期四"
+    assert pool.take("default") == "第二条文案：V我50吃原味鸡"
+    assert pool.take("default") is None
+    assert pool.take("missing") is None
+
+    # 已发出的文案不能再次入池，但只记住最近history_size条
+    assert not pool.add("default", "第二条文案：V我50吃原味鸡")
+    assert pool.add("default", "第一条文案：疯狂星期四")
+
+
+def test_copies_sent_outside_the_pool_are_deduplicated(plugin_module):
+    pool = plugin_module.CopyPool(similarity=0.6)
+    pool.mark_served("default", "群发的文案：今天疯狂星期四，V我50")
+    assert not pool.add("default", "群发的文案：今天疯狂星期四，V我50！")
+    assert pool.size("default") == 0
+
+    pool.clear()
+    assert pool.add("default", "群发的文案：今天疯狂星期四，V我50！")
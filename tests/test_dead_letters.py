@@ -0,0 +1,44 @@
+import asyncio
+import datetime
+
+# 2024-01-01 是周一
+START = datetime.datetime(2024, 1, 1)
+
+
+def test_failed_sends_retry_then_dead_letter_and_replay(plugin_module, make_context):
+    config = {"enabled_groups": ["1001"], "retry_max_attempts": 2, "retry_base_delay_seconds": 1}
+    clock = plugin_module.SimulatedClock(START)
+    context = make_context()
+
+    async def scenario():
+        plugin = plugin_module.KFCThursdayPlugin(context, config, clock=clock, dry_run=True)
+        attempts = []
+
+        async def failing_send(platform, limiter, group_id, prompt, slot_key, llm_timeout=None):
+            attempts.append(clock.time())
+            return False
+
+        try:
+            plugin._send_to_group = failing_send
+            plugin._ledger.begin_slot("slot", "prompt", clock.time(), ["1001"])
+            await plugin._broadcast_slot("slot", "prompt", ["1001"])
+            await clock.run_until(START + datetime.timedelta(hours=1))
+            assert len(attempts) == 3
+            assert [entry["group_id"] for entry in plugin._dead_letters.entries()] == ["1001"]
+            assert plugin._ledger.statuses("slot", ["1001"]) == {"1001": "failed"}
+
+            # 没有可用平台时重放不会丢失死信
+            platforms, context.platform_manager.platforms = context.platform_manager.platforms, []
+            assert await plugin.replay_dead_letters() == (0, 0)
+            assert len(plugin._dead_letters) == 1
+            assert plugin._ledger.statuses("slot", ["1001"]) == {"1001": "failed"}
+
+            context.platform_manager.platforms = platforms
+            del plugin._send_to_group
+            assert await plugin.replay_dead_letters() == (1, 1)
+            assert len(plugin._dead_letters) == 0
+            assert plugin._ledger.statuses("slot", ["1001"]) == {"1001": "sent"}
+        finally:
+            await plugin.terminate()
+
+    asyncio.run(scenario())
@@ -0,0 +1,97 @@
+import asyncio
+import datetime
+
+import pytest
+
+START = datetime.datetime(2024, 1, 4, 12, 0)
+
+
+def test_concurrent_requests_share_one_generation(plugin_module):
+    cache = plugin_module.GenerationCache()
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0)
+        return "V我50"
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get_or_create("key", factory) for _ in range(5)))
+
+    assert asyncio.run(scenario()) == ["V我50"] * 5
+    assert len(calls) == 1
+
+
+def test_timeout_counts_from_task_start_and_does_not_cancel_shared_task(plugin_module):
+    clock = plugin_module.SimulatedClock(START)
+    cache = plugin_module.GenerationCache(clock=clock)
+
+    async def scenario():
+        done = asyncio.Event()
+
+        async def factory():
+            await done.wait()
+            return "文案"
+
+        first = asyncio.ensure_future(cache.get_or_create("key", factory))
+        await asyncio.sleep(0)
+        # 任务已运行10秒，后来的等待方即使给了5秒超时也立即超时
+        clock._now += 10
+        with pytest.raises(asyncio.TimeoutError):
+            await cache.get_or_create("key", factory, timeout=5)
+
+        # 超时的等待方离开后，共享的生成任务仍在运行，其他等待方拿到结果
+        done.set()
+        return await first, await cache.get_or_create("key", factory, timeout=5)
+
+    assert asyncio.run(scenario()) == ("文案", "文案")
+
+
+def test_finished_result_is_returned_after_timeout_elapsed(plugin_module):
+    clock = plugin_module.SimulatedClock(START)
+    cache = plugin_module.GenerationCache(clock=clock)
+
+    async def factory():
+        return "文案"
+
+    async def scenario():
+        await cache.get_or_create("key", factory, timeout=1)
+        clock._now += 3600
+        return await cache.get_or_create("key", factory, timeout=1)
+
+    assert asyncio.run(scenario()) == "文案"
+
+
+def test_failed_generation_is_not_cached(plugin_module):
+    cache = plugin_module.GenerationCache()
+    results = iter([RuntimeError("模拟生成失败"), "文案"])
+
+    async def factory():
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await cache.get_or_create("key", factory)
+        await asyncio.sleep(0)
+        return await cache.get_or_create("key", factory)
+
+    assert asyncio.run(scenario()) == "文案"
+
+
+def test_oldest_entries_are_evicted(plugin_module):
+    cache = plugin_module.GenerationCache(max_entries=2)
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        return len(calls)
+
+    async def scenario():
+        for key in ("a", "b", "c", "a"):
+            await cache.get_or_create(key, factory)
+
+    asyncio.run(scenario())
+    assert len(calls) == 4
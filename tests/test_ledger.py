@@ -0,0 +1,35 @@
+import datetime
+
+# 2024-01-01 是周一
+START = datetime.datetime(2024, 1, 1)
+
+
+def test_ledger_claims_are_exclusive_and_resumable(plugin_module, tmp_path):
+    clock = plugin_module.SimulatedClock(START)
+    path = str(tmp_path / "ledger.db")
+    first = plugin_module.SendLedger(path, claim_ttl=300, clock=clock)
+    second = plugin_module.SendLedger(path, claim_ttl=300, clock=clock)
+    try:
+        first.begin_slot("slot", "prompt", clock.time(), ["1001", "1002"])
+        assert first.claim("slot", "1001")
+        assert not second.claim("slot", "1001")
+        first.mark("slot", "1001", "sent")
+        first.finish_slot("slot")
+
+        # 1002 还未发送，时间点仍未完成，可被补发
+        assert not first.is_slot_done("slot")
+        assert second.unfinished_slots(clock.time() - 3600) == [("slot", "prompt")]
+        assert second.pending_groups("slot") == ["1002"]
+
+        # 认领过期后其他实例可以接管
+        assert second.claim("slot", "1002")
+        clock._now += 301
+        assert first.claim("slot", "1002")
+        first.mark("slot", "1002", "sent")
+        second.mark("slot", "1002", "failed")  # 已被接管，原认领者不能再改写结果
+        first.finish_slot("slot")
+        assert first.is_slot_done("slot")
+        assert first.statuses("slot", ["1001", "1002"]) == {"1001": "sent", "1002": "sent"}
+    finally:
+        first.close()
+        second.close()
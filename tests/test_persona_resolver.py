@@ -0,0 +1,83 @@
+import asyncio
+
+
+class CountingConversationManager:
+    """记录会话管理器调用次数，可切换群的当前会话"""
+
+    def __init__(self, conversation_manager):
+        self._inner = conversation_manager
+        self.calls = 0
+        self.current = {}
+
+    async def get_curr_conversation_id(self, unified_msg_origin):
+        self.calls += 1
+        return self.current.get(unified_msg_origin) or await self._inner.get_curr_conversation_id(unified_msg_origin)
+
+    async def new_conversation(self, unified_msg_origin):
+        self.calls += 1
+        return await self._inner.new_conversation(unified_msg_origin)
+
+    async def get_conversation(self, unified_msg_origin, conversation_id):
+        self.calls += 1
+        conversation = await self._inner.get_conversation(unified_msg_origin, conversation_id)
+        conversation.cid = conversation_id
+        return conversation
+
+
+def make_resolver(plugin_module, make_context):
+    context = make_context()
+    context.provider_manager = type("ProviderManager", (), {})()
+    context.provider_manager.personas = [{"name": "default", "prompt": "旧提示词"}]
+    context.provider_manager.selected_default_persona = {"name": "default"}
+    context.conversation_manager = CountingConversationManager(context.conversation_manager)
+    return context, plugin_module.PersonaResolver(context)
+
+
+def test_prefetched_slot_serves_conversations_without_manager_calls(plugin_module, make_context):
+    context, resolver = make_resolver(plugin_module, make_context)
+
+    async def scenario():
+        await resolver.prefetch("slot", ["1001", "1002"])
+        calls = context.conversation_manager.calls
+        conversations = [await resolver.get_conversation(group_id, "slot") for group_id in ("1001", "1002")]
+        return calls, conversations
+
+    calls, conversations = asyncio.run(scenario())
+    assert calls == 4
+    assert context.conversation_manager.calls == 4
+    assert all(conversation is not None for conversation in conversations)
+
+
+def test_commands_always_resolve_the_current_conversation(plugin_module, make_context):
+    context, resolver = make_resolver(plugin_module, make_context)
+    origin = "aiocqhttp:GROUP_MESSAGE:1001"
+
+    async def scenario():
+        first = await resolver.resolve("1001")
+        context.conversation_manager.current[origin] = "switched"
+        second = await resolver.resolve("1001")
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first.cid != "switched"
+    assert second.cid == "switched"
+
+
+def test_persona_index_picks_up_in_place_edits_on_new_slot(plugin_module, make_context):
+    context, resolver = make_resolver(plugin_module, make_context)
+    conversation = type("Conversation", (), {"persona_id": "default"})()
+    assert resolver.personality_prompt(conversation, None) == "旧提示词"
+
+    context.provider_manager.personas[0]["prompt"] = "新提示词"
+    # 同一时间点内查找只访问字典，原地修改在下一个时间点或配置重载时生效
+    assert resolver.personality_prompt(conversation, None) == "旧提示词"
+    asyncio.run(resolver.prefetch("next-slot", []))
+    assert resolver.personality_prompt(conversation, None) == "新提示词"
+
+    context.provider_manager.personas[0]["prompt"] = "重载后的提示词"
+    resolver.invalidate()
+    assert resolver.personality_prompt(conversation, None) == "重载后的提示词"
+
+    context.provider_manager.personas.append({"name": "other", "prompt": "其他"})
+    conversation.persona_id = "other"
+    assert resolver.personality_prompt(conversation, None) == "其他"
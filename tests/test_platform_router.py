@@ -0,0 +1,64 @@
+import random
+
+import benchmark
+
+GROUPS = [str(100000 + i) for i in range(300)]
+
+
+def make_platforms(count: int) -> list:
+    rng = random.Random(0)
+    return [benchmark.FakePlatform(f"qq{i}", benchmark.FakeClient(0.0, 0.0, rng)) for i in range(count)]
+
+
+def assignment(router, routes) -> dict:
+    return {group_id: router.platform_key(platform) for platform, groups in routes for group_id in groups}
+
+
+def test_consistent_hash_spreads_groups_and_moves_few_on_change(plugin_module):
+    platforms = make_platforms(4)
+    router = plugin_module.PlatformRouter()
+    before = assignment(router, router.route_groups(platforms, GROUPS))
+    assert sorted(before) == sorted(GROUPS)
+    counts = [list(before.values()).count(f"qq{i}") for i in range(4)]
+    assert min(counts) > len(GROUPS) / 4 / 2
+
+    # 结果与实例顺序无关
+    reordered = plugin_module.PlatformRouter()
+    assert assignment(reordered, reordered.route_groups(platforms[::-1], GROUPS)) == before
+
+    # 增加一个实例时只迁移到新实例，其余群保持不变
+    platforms.append(make_platforms(5)[4])
+    after = assignment(router, router.route_groups(platforms, GROUPS))
+    moved = [group_id for group_id in GROUPS if after[group_id] != before[group_id]]
+    assert moved
+    assert all(after[group_id] == "qq4" for group_id in moved)
+    assert len(moved) < len(GROUPS) / 2
+
+
+def test_explicit_routes_override_hash_and_first_mode(plugin_module):
+    platforms = make_platforms(3)
+    router = plugin_module.PlatformRouter()
+    explicit = ("100000:qq2", "100001 : qq1", "100002:missing")
+
+    routes = assignment(router, router.route_groups(platforms, GROUPS, "first", explicit))
+    assert routes["100000"] == "qq2"
+    assert routes["100001"] == "qq1"
+    # 指向不存在实例的路由被忽略
+    assert routes["100002"] == "qq0"
+    assert all(routes[group_id] == "qq0" for group_id in GROUPS[3:])
+
+    hashed = assignment(router, router.route_groups(platforms, GROUPS, "consistent_hash", explicit))
+    assert hashed["100000"] == "qq2"
+    assert hashed["100001"] == "qq1"
+
+
+def test_routes_are_cached_and_skip_other_platforms(plugin_module):
+    platforms = make_platforms(2)
+    other = benchmark.FakePlatform("tg", None)
+    other.meta().name = "telegram"
+    router = plugin_module.PlatformRouter()
+
+    routes = router.route_groups(platforms + [other], GROUPS)
+    assert router.route_groups(platforms + [other], GROUPS) is routes
+    assert {router.platform_key(platform) for platform, _ in routes} == {"qq0", "qq1"}
+    assert router.route_groups([other], GROUPS) == []
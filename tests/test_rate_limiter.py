@@ -0,0 +1,34 @@
+import datetime
+
+START = datetime.datetime(2024, 1, 4, 12, 0)
+
+
+def test_keyed_rate_limiter_checks_without_consuming(plugin_module):
+    clock = plugin_module.SimulatedClock(START)
+    limiter = plugin_module.KeyedRateLimiter(2, clock)
+    assert limiter.check("1001")
+    assert limiter.check("1001")
+    assert limiter.allow("1001")
+    assert limiter.allow("1001")
+    assert not limiter.check("1001")
+    assert not limiter.allow("1001")
+    # 各键独立计数
+    assert limiter.allow("1002")
+
+    # 每分钟2个令牌，30秒后补充一个
+    clock._now += 30
+    assert limiter.allow("1001")
+    assert not limiter.allow("1001")
+
+
+def test_keyed_rate_limiter_unlimited_and_bounded(plugin_module):
+    unlimited = plugin_module.KeyedRateLimiter(0)
+    assert all(unlimited.allow("1001") for _ in range(100))
+    assert not unlimited._buckets
+
+    limiter = plugin_module.KeyedRateLimiter(1, plugin_module.SimulatedClock(START), max_keys=2)
+    for key in ("a", "b", "c"):
+        assert limiter.allow(key)
+    assert list(limiter._buckets) == ["b", "c"]
+    # 被淘汰的键重新获得完整的令牌桶
+    assert limiter.allow("a")
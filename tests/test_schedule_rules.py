@@ -0,0 +1,42 @@
+import asyncio
+import datetime
+
+# 2024-01-01 是周一
+START = datetime.datetime(2024, 1, 1)
+
+
+def test_schedule_rules_compile_into_weekly_index(plugin_module):
+    rule = plugin_module.ScheduleRule.parse("r1", "30 9 * * 1-5 | 早安 | 1001,1002 | 2024-01-03~2024-01-04")
+    assert rule.weekdays == frozenset(range(5))
+    assert rule.groups == ("1001", "1002")
+    assert rule.prompt == "早安"
+
+    index = plugin_module.ScheduleIndex([rule])
+    assert len(index) == 5
+    fires = [fire_at for fire_at, _ in index.upcoming(START, 4)]
+    # 周三、周四被排除
+    assert fires == [
+        datetime.datetime(2024, 1, 1, 9, 30),
+        datetime.datetime(2024, 1, 2, 9, 30),
+        datetime.datetime(2024, 1, 5, 9, 30),
+        datetime.datetime(2024, 1, 8, 9, 30),
+    ]
+
+
+def test_same_minute_rules_assign_each_group_once(plugin_module, make_context):
+    config = {
+        "enabled_groups": ["1001", "1002", "1003"],
+        "schedule_rules": ["0 10 * * 4 | 星期四上午 | 1002"],
+    }
+
+    async def scenario():
+        plugin = plugin_module.KFCThursdayPlugin(make_context(), config, dry_run=True)
+        try:
+            fire_at, rules = plugin._view.index.next_fire(START)
+            return fire_at, [(rule.key, groups) for rule, groups in plugin._assign_groups(rules)]
+        finally:
+            await plugin.terminate()
+
+    fire_at, assignments = asyncio.run(scenario())
+    assert fire_at == datetime.datetime(2024, 1, 4, 10, 0)
+    assert assignments == [("morning", ["1001", "1003"]), ("rule1", ["1002"])]
@@ -0,0 +1,89 @@
+import asyncio
+import datetime
+import os
+
+# 2024-01-01 是周一，28天内有4个星期四
+START = datetime.datetime(2024, 1, 1)
+THURSDAYS = ("2024-01-04", "2024-01-11", "2024-01-18", "2024-01-25")
+THURSDAY_SLOTS = ("10:00#morning", "12:00#noon", "18:00#evening", "18:30#custom", "20:00#night")
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def expected_slots():
+    return sorted(f"{day}_{slot}" for day in THURSDAYS for slot in THURSDAY_SLOTS)
+
+
+async def simulate_month(plugin_module, context, clock=None):
+    """按默认配置用虚拟时钟运行28天，返回(时间点列表, 唤醒次数)"""
+    config = {"enabled_groups": ["1001", "1002"]}
+    clock = clock or plugin_module.SimulatedClock(START)
+    plugin = plugin_module.KFCThursdayPlugin(context, config, clock=clock, dry_run=True)
+    try:
+        await clock.run_until(START + datetime.timedelta(days=28))
+    finally:
+        await plugin.terminate()
+    slots = sorted({slot_key for _, slot_key, _, _ in plugin._dry_run_sends})
+    return slots, plugin._dry_run_sends, plugin._metrics.counters.get(("scheduler_wakeup",), 0)
+
+
+def test_simulate_month_fires_every_thursday_slot(plugin_module, make_context):
+    async def scenario():
+        plugin = plugin_module.KFCThursdayPlugin(make_context(), {"enabled_groups": ["1001", "1002"]}, dry_run=True)
+        try:
+            return await plugin.simulate(28, START)
+        finally:
+            await plugin.terminate()
+
+    result = run(scenario())
+    assert result["slots"] == expected_slots()
+    assert result["sends"] == len(expected_slots()) * 2
+    # 每个时间点唤醒两次：提前预生成一次，到点发送一次
+    assert result["wakeups"] == len(expected_slots()) * 2
+    assert result["prewarms"] == len(expected_slots())
+
+
+def test_simulated_clock_settles_without_ready_queue(plugin_module, make_context):
+    class PortableClock(plugin_module.SimulatedClock):
+        @staticmethod
+        def _ready_queue():
+            return None
+
+    slots, sends, wakeups = run(simulate_month(plugin_module, make_context(), PortableClock(START)))
+    assert slots == expected_slots()
+    assert wakeups == len(expected_slots()) * 2
+    # 发送时间不早于时间点
+    for sent_at, slot_key, _, _ in sends:
+        assert sent_at.strftime("%Y-%m-%d_%H:%M") == slot_key.split("#")[0]
+
+
+
+
+
+def test_simulate_leaves_live_files_and_config_untouched(plugin_module, make_context):
+    plugin_dir = os.path.dirname(plugin_module.__file__)
+    live_store = plugin_module.PregeneratedStore(os.path.join(plugin_dir, "pregenerated.json"))
+    live_store.put(["2024-01-04_12:00#noon", "prompt", "", None], "2024-01-04_12:00#noon", "已生成的文案")
+    live_store.flush()
+    with open(live_store.path, encoding="utf-8") as f:
+        before = f.read()
+    # 关闭预生成，正在运行的插件自己不会写预生成文案
+    config = {"enabled_groups": ["1001"], "pregenerate_lead_minutes": 0}
+
+    async def scenario():
+        clock = plugin_module.SimulatedClock(datetime.datetime(2024, 1, 4, 11, 55))
+        plugin = plugin_module.KFCThursdayPlugin(make_context(), config, clock=clock)
+        try:
+            result = await plugin.simulate(1)
+        finally:
+            await plugin.terminate()
+        return result
+
+    result = run(scenario())
+    assert "2024-01-04_12:00#noon" in result["slots"]
+    with open(live_store.path, encoding="utf-8") as f:
+        assert f.read() == before
+    assert not os.path.exists(os.path.join(plugin_dir, "dead_letters.json"))
+    assert config == {"enabled_groups": ["1001"], "pregenerate_lead_minutes": 0}
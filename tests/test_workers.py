@@ -0,0 +1,34 @@
+import datetime
+
+# 2024-01-01 是周一
+START = datetime.datetime(2024, 1, 1)
+
+
+def test_claims_of_dead_workers_are_released(plugin_module, tmp_path):
+    clock = plugin_module.SimulatedClock(START)
+    path = str(tmp_path / "ledger.db")
+    alive_ledger = plugin_module.SendLedger(path, clock=clock)
+    dead_ledger = plugin_module.SendLedger(path, clock=clock)
+    alive = plugin_module.SQLiteWorkerCoordinator(path, alive_ledger.owner, clock, ttl=30)
+    dead = plugin_module.SQLiteWorkerCoordinator(path, dead_ledger.owner, clock, ttl=30)
+    try:
+        alive.heartbeat()
+        dead.heartbeat()
+        groups = [str(1000 + i) for i in range(100)]
+        owned = set(alive.partition(groups))
+        assert owned.isdisjoint(dead.partition(groups))
+        assert owned | set(dead.partition(groups)) == set(groups)
+
+        alive_ledger.begin_slot("slot", "prompt", clock.time(), groups)
+        assert dead_ledger.claim("slot", groups[0])
+        assert alive_ledger.release_claims("slot", alive.live_workers()) == 0
+
+        clock._now += 31
+        alive.heartbeat()
+        assert alive.live_workers() == [alive_ledger.owner]
+        assert alive.partition(groups) == groups
+        assert alive_ledger.release_claims("slot", alive.live_workers()) == 1
+        assert alive_ledger.claim("slot", groups[0])
+    finally:
+        for closable in (alive, dead, alive_ledger, dead_ledger):
+            closable.close()